@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""Benchmark backups of a synthetic athlete without a Strava account or network
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench --activities 1000 --latency 0.05
+
+Each scenario backs up to its own temporary output directory:
+ - cold: back up everything to an empty output directory
+ - warm: run again after a complete backup (nothing to download)
+ - rescan: run again after a complete backup, rebuilding the index
+ - resume: finish a backup that was stopped halfway through
+ - import: back up after importing a bulk export that is missing a file. Fails
+   unless only the missing file is downloaded
+ - partial: finish a backup that was stopped while downloading photos. Fails
+   unless the partial downloads are resumed
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from stravabackup import StravaBackup, import_export, open_output_dir
+from stravabackup.ratelimit import RateLimiter
+from stravabackup.storage import LAYOUTS
+
+from benchmarks.fake_strava import Athlete, FakeClient, PhotoServer, Stats
+
+
+# (backup options for setting up the output directory, options for the measured run)
+# `None` means the output directory is left empty, `IMPORT` means a bulk
+# export is imported into it, and `PARTIAL` means a complete backup's photos are
+# turned back into partial downloads
+IMPORT = "import"
+PARTIAL = "partial"
+SCENARIOS = {
+    "cold": (None, {}),
+    "warm": ({}, {}),
+    "rescan": ({}, {"rescan": True}),
+    "resume": ({"limit": 0.5}, {}),
+    "import": (IMPORT, {}),
+    "partial": (PARTIAL, {}),
+}
+
+
+class BenchmarkRateLimiter(RateLimiter):
+    """A rate limiter that records how long requests waited for it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waited = 0
+        self._wait_lock = threading.Lock()
+
+    def acquire(self, kind="api"):
+        start = time.perf_counter()
+        waited = super().acquire(kind)
+        with self._wait_lock:
+            self.waited += time.perf_counter() - start
+        return waited
+
+
+class BenchmarkBackup(StravaBackup):
+    """Backs up using a fake client"""
+
+    def __init__(self, *, client, **kwargs):
+        self._fake_client = client
+        super().__init__(access_token="benchmark", email=None, password=None, jwt=None, **kwargs)
+
+    def _make_client(self, *args, **kwargs):
+        return self._fake_client
+
+
+def _snapshot(path):
+    """Get the size and modification time of all files under the path"""
+    files = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            p = os.path.join(dirpath, filename)
+            st = os.stat(p)
+            files[p] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def _backup(args, athlete, photos, stats, out_dir, *, limit=None, rescan=False):
+    """Run a backup of the athlete"""
+    windows = {"short": args.rate_window, "long": args.rate_window * 96}
+    limiter = BenchmarkRateLimiter(windows=windows, web_limits=args.web_rate_limit)
+    client = FakeClient(
+        athlete, stats,
+        photo_url=photos.url,
+        latency=args.latency,
+        web_latency=args.web_latency,
+        rate_limiter=limiter,
+        rate_limits=args.rate_limit,
+        rate_windows=tuple(windows.values()),
+    )
+    if limit is not None:
+        limit = int(len(athlete.activities) * limit)
+
+    with BenchmarkBackup(client=client, out_dir=out_dir, rescan=rescan, rate_limiter=limiter,
+                         compress=args.compress, dedup=args.dedup, layout=args.layout,
+                         tracks=args.tracks) as sb:
+        sb.run_backup(limit=limit, workers=args.workers)
+    return limiter
+
+
+def _import(args, athlete, out_dir):
+    """Import a synthetic bulk export of the athlete
+
+    Returns the IDs of the activities that were missing from the export.
+    """
+    export = os.path.join(os.path.dirname(out_dir), "export.zip")
+    missing = athlete.write_export(export)
+    import_export(out_dir, export, layout=args.layout, compress=args.compress, dedup=args.dedup)
+    os.remove(export)
+    return missing
+
+
+def _leave_partials(out_dir, fraction=0.5):
+    """Turn the photos of a backup back into partial downloads
+
+    Keeps the start of each photo in its partial file as if the backup was
+    stopped while downloading them (so it didn't record how far it got
+    either). Returns the number of photos.
+    """
+    count = 0
+    with open_output_dir(out_dir) as (index, storage):
+        for path, _, photo_id, meta, _ in list(index.files()):
+            if photo_id is None or meta:
+                continue
+            data = storage.read(path)
+            with open(storage.partial_path(path), "wb") as f:
+                f.write(data[:int(len(data) * fraction)])
+            storage.remove(path)
+            index.remove_file(path)
+            count += 1
+        index.set_state("cursor", None)
+    return count
+
+
+def run_scenario(args, athlete, photos, name):
+    setup, options = SCENARIOS[name]
+    stats = photos.stats = Stats()
+    missing = partials = None
+    with tempfile.TemporaryDirectory(prefix="strava-backup-bench-", dir=args.tmpdir) as tmp:
+        out_dir = os.path.join(tmp, "out")
+        if setup == IMPORT:
+            missing = _import(args, athlete, out_dir)
+        elif setup == PARTIAL:
+            _backup(args, athlete, photos, stats, out_dir)
+            partials = _leave_partials(out_dir)
+            stats.reset()
+        elif setup is not None:
+            _backup(args, athlete, photos, stats, out_dir, **setup)
+            stats.reset()
+
+        before = _snapshot(out_dir)
+        tracemalloc.start()
+        start = time.perf_counter()
+        limiter = _backup(args, athlete, photos, stats, out_dir, **options)
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        after = _snapshot(out_dir)
+
+    downloaded = stats.requests.get("web:get_activity_data", 0)
+    if missing is not None and downloaded != len(missing):
+        raise RuntimeError("Downloaded {} original file(s) after importing an export missing {}"
+                           .format(downloaded, len(missing)))
+    if partials is not None and stats.resumed != partials:
+        raise RuntimeError("Resumed {} of {} partially downloaded photo(s)"
+                           .format(stats.resumed, partials))
+
+    written = [p for p, v in after.items() if before.get(p) != v]
+    return {
+        "scenario": name,
+        "wall_time": wall,
+        "requests": dict(sorted(stats.requests.items())),
+        "throttled": stats.throttled,
+        "resumed": stats.resumed,
+        "bytes_downloaded": stats.bytes_served,
+        "rate_limit_wait": limiter.waited,
+        "peak_memory": peak,
+        "files_written": len(written),
+        "bytes_written": sum(after[p][0] for p in written),
+    }
+
+
+def _print_results(results):
+    columns = (
+        ("scenario", "{:<8}", lambda r: r["scenario"]),
+        ("wall (s)", "{:>9.2f}", lambda r: r["wall_time"]),
+        ("api", "{:>6}", lambda r: sum(v for k, v in r["requests"].items() if k.startswith("api:"))),
+        ("web", "{:>6}", lambda r: sum(v for k, v in r["requests"].items() if k.startswith("web:"))),
+        ("photo", "{:>6}", lambda r: r["requests"].get("photo", 0)),
+        ("resumed", "{:>7}", lambda r: r["resumed"]),
+        ("429s", "{:>5}", lambda r: r["throttled"]),
+        ("rl wait (s)", "{:>11.2f}", lambda r: r["rate_limit_wait"]),
+        ("peak mem (MiB)", "{:>14.1f}", lambda r: r["peak_memory"] / 2 ** 20),
+        ("files", "{:>6}", lambda r: r["files_written"]),
+        ("written (MiB)", "{:>13.1f}", lambda r: r["bytes_written"] / 2 ** 20),
+    )
+    print("  ".join(
+        "{:<{w}}".format(name, w=len(fmt.format(get(results[0])))) for name, fmt, get in columns
+    ))
+    for r in results:
+        print("  ".join(fmt.format(get(r)) for _, fmt, get in columns))
+
+
+def _parse_limits(value):
+    short, long = (int(x) for x in value.split(","))
+    return short, long
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark backups of a synthetic athlete against a fake Strava"
+    )
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS),
+                        help="The scenarios to run ({}, default: all)".format(", ".join(SCENARIOS)))
+    data = parser.add_argument_group("synthetic athlete")
+    data.add_argument("--activities", type=int, default=200,
+                      help="The number of activities (default: %(default)s)")
+    data.add_argument("--photo-fraction", type=float, default=0.2,
+                      help="The fraction of activities with photos (default: %(default)s)")
+    data.add_argument("--photos", type=int, default=2,
+                      help="The number of photos on activities with photos (default: %(default)s)")
+    data.add_argument("--photo-size", type=int, default=200 * 1024,
+                      help="The size of each photo in bytes (default: %(default)s)")
+    data.add_argument("--points", type=int, default=1000,
+                      help="The number of points in each activity (default: %(default)s)")
+    data.add_argument("--bikes", type=int, default=2,
+                      help="The number of bikes (default: %(default)s)")
+    data.add_argument("--shoes", type=int, default=2,
+                      help="The number of shoes (default: %(default)s)")
+    data.add_argument("--seed", type=int, default=0,
+                      help="The seed used to generate the data (default: %(default)s)")
+
+    server = parser.add_argument_group("fake Strava")
+    server.add_argument("--latency", type=float, default=0.0,
+                        help="The latency of API requests in seconds (default: %(default)s)")
+    server.add_argument("--web-latency", type=float, default=0.0,
+                        help="The latency of website requests in seconds (default: %(default)s)")
+    server.add_argument("--photo-latency", type=float, default=0.0,
+                        help="The latency of photo requests in seconds (default: %(default)s)")
+    server.add_argument("--rate-limit", type=_parse_limits, default=(10 ** 6, 10 ** 7),
+                        help="The API rate limits (<short>,<long>) after which requests are "
+                             "throttled (default: unlimited)")
+    server.add_argument("--rate-window", type=int, default=15 * 60,
+                        help="The length of the short rate limit window in seconds. The long "
+                             "window is 96 times longer (default: %(default)s)")
+    server.add_argument("--web-rate-limit", type=lambda x: dict(zip(("short", "long"), _parse_limits(x))),
+                        default=None, help="Limit website requests (<short>,<long>)")
+
+    backup = parser.add_argument_group("backup options")
+    backup.add_argument("--workers", type=int, default=1,
+                        help="The number of activities to download in parallel (default: %(default)s)")
+    backup.add_argument("--layout", choices=sorted(LAYOUTS), default="tree",
+                        help="The layout of the output directory (default: %(default)s)")
+    backup.add_argument("--compress", default=None, help="Compress original activity files")
+    backup.add_argument("--dedup", action="store_true", default=False,
+                        help="Deduplicate original files and photos")
+    backup.add_argument("--tracks", action="store_true", default=False,
+                        help="Decode tracks from original activity files")
+
+    parser.add_argument("--tmpdir", default=None,
+                        help="Where to create the output directories (default: the system temp dir)")
+    parser.add_argument("--json", type=argparse.FileType("wt"), default=None,
+                        help="Write the results to a file as JSON")
+    parser.add_argument("--debug", action="store_true", default=False,
+                        help="Output the log messages of the backups")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("Unknown scenario(s): {}".format(", ".join(sorted(unknown))))
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.CRITICAL)
+
+    athlete = Athlete(
+        activities=args.activities,
+        photo_fraction=args.photo_fraction,
+        photos=args.photos,
+        bikes=args.bikes,
+        shoes=args.shoes,
+        points=args.points,
+        seed=args.seed,
+    )
+    results = []
+    with PhotoServer(Stats(), size=args.photo_size, latency=args.photo_latency) as photos:
+        for name in args.scenarios:
+            results.append(run_scenario(args, athlete, photos, name))
+
+    _print_results(results)
+    if args.json:
+        json.dump(results, args.json, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
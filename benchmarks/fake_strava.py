@@ -0,0 +1,392 @@
+"""A local stand-in for the Strava API, website and photo CDN
+
+The API and website are simulated in-process by a fake client. Photos are
+served over HTTP by a local server so they're downloaded by the real code.
+"""
+
+from collections import Counter
+import csv
+import datetime
+import gzip
+import http.server
+import io
+import random
+import re
+import threading
+import time
+import zipfile
+
+from stravalib import model
+from stravaweblib import ExportFile
+
+
+TIME_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Activities are listed by the API in pages of this size
+PAGE_SIZE = 200
+
+ACTIVITY_TYPES = ("Ride", "Run", "Walk", "Hike", "Swim")
+
+
+class Stats:
+    """Counts the requests made to the fake services"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.throttled = 0
+        self.resumed = 0
+        self.bytes_served = 0
+
+    def request(self, endpoint, size=0):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes_served += size
+
+    def served(self, size):
+        with self._lock:
+            self.bytes_served += size
+
+    def throttle(self):
+        with self._lock:
+            self.throttled += 1
+
+    def resume(self):
+        with self._lock:
+            self.resumed += 1
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.throttled = 0
+            self.resumed = 0
+            self.bytes_served = 0
+
+
+class Athlete:
+    """A synthetic athlete with activities, photos and gear
+
+    The data is generated deterministically from the seed.
+    """
+
+    def __init__(self, *, activities=100, photo_fraction=0.2, photos=2, manual_fraction=0.05,
+                 bikes=2, shoes=2, points=1000, seed=0):
+        rng = random.Random(seed)
+        self.points = points
+        self._gpx_points = None
+        self.bikes = ["b{}".format(i) for i in range(1, bikes + 1)]
+        self.shoes = ["g{}".format(i) for i in range(1, shoes + 1)]
+
+        # Roughly one activity a day up until the start of 2024
+        end = datetime.datetime(2024, 1, 1)
+        self.activities = {}
+        for i in range(1, activities + 1):
+            start = end - datetime.timedelta(days=activities - i, seconds=rng.randrange(86400))
+            type_ = rng.choice(ACTIVITY_TYPES)
+            gear = self.bikes if type_ == "Ride" else self.shoes if type_ in ("Run", "Walk", "Hike") else []
+            moving_time = rng.randrange(600, 4 * 3600)
+            distance = moving_time * rng.uniform(1, 10)
+            self.activities[i] = {
+                "id": i,
+                "name": "{} {}".format(type_, i),
+                "type": type_,
+                "start_date": start,
+                "distance": round(distance, 1),
+                "moving_time": moving_time,
+                "elapsed_time": moving_time + rng.randrange(600),
+                "total_elevation_gain": round(rng.uniform(0, 1000), 1),
+                "average_speed": round(distance / moving_time, 3),
+                "max_speed": round(distance / moving_time * rng.uniform(1, 3), 3),
+                "manual": rng.random() < manual_fraction,
+                "commute": rng.random() < 0.1,
+                "trainer": False,
+                "private": False,
+                "gear_id": rng.choice(gear) if gear else None,
+                "total_photo_count": photos if rng.random() < photo_fraction else 0,
+            }
+
+    def summary(self, activity_id):
+        a = dict(self.activities[activity_id])
+        a["start_date"] = a["start_date"].strftime(TIME_FMT)
+        return a
+
+    def detail(self, activity_id):
+        a = self.summary(activity_id)
+        a["description"] = "Synthetic activity {}".format(activity_id)
+        a["calories"] = round(a["moving_time"] / 6, 1)
+        a["device_name"] = "Benchmark"
+        return a
+
+    def photos(self, activity_id, base_url):
+        return [
+            {
+                "unique_id": "{}-{}".format(activity_id, n),
+                "activity_id": activity_id,
+                "source": 1,
+                "caption": "Photo {} of activity {}".format(n, activity_id),
+                "created_at": self.summary(activity_id)["start_date"],
+                "urls": {"5000": "{}/photos/{}/{}.jpg".format(base_url, activity_id, n)},
+            }
+            for n in range(self.activities[activity_id]["total_photo_count"])
+        ]
+
+    def _points(self):
+        """The points of all activities (generated once to keep the fake fast)"""
+        if self._gpx_points is None:
+            rng = random.Random(self.points)
+            lat, lon = rng.uniform(-60, 60), rng.uniform(-180, 180)
+            start = datetime.datetime(2020, 1, 1)
+            points = []
+            for n in range(self.points):
+                lat += rng.uniform(-1e-4, 1e-4)
+                lon += rng.uniform(-1e-4, 1e-4)
+                points.append(
+                    '<trkpt lat="{:.7f}" lon="{:.7f}"><ele>{:.1f}</ele><time>{}</time></trkpt>\n'.format(
+                        lat, lon, rng.uniform(0, 500),
+                        (start + datetime.timedelta(seconds=n)).strftime(TIME_FMT)
+                    )
+                )
+            self._gpx_points = "".join(points).encode("utf8")
+        return self._gpx_points
+
+    def gpx(self, activity_id, chunk_size=64 * 1024):
+        """Yield the original GPX file of an activity in chunks"""
+        yield (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">'
+            '<trk><name>{}</name><trkseg>\n'.format(self.activities[activity_id]["name"])
+        ).encode("utf8")
+        points = self._points()
+        for i in range(0, len(points), chunk_size):
+            yield points[i:i + chunk_size]
+        yield b"</trkseg></trk></gpx>\n"
+
+    def write_export(self, path, *, missing=1):
+        """Write a bulk export ZIP of the athlete's original files
+
+        Like a real export, the activities list repeats some column names,
+        manual activities have no file, and every other file is gzipped. The
+        last `missing` files are listed but left out of the ZIP. Returns the
+        IDs of the activities whose files are missing.
+        """
+        listed = io.StringIO()
+        writer = csv.writer(listed)
+        writer.writerow(["Activity ID", "Activity Date", "Activity Name", "Activity Type",
+                         "Elapsed Time", "Filename", "Elapsed Time", "Distance"])
+        uploaded = [i for i, a in self.activities.items() if not a["manual"]]
+        missing_ids = uploaded[len(uploaded) - missing:] if missing else []
+
+        with zipfile.ZipFile(path, "w") as zf:
+            for n, (activity_id, a) in enumerate(self.activities.items()):
+                filename = ""
+                if not a["manual"]:
+                    filename = "activities/{}.gpx".format(activity_id + 10 ** 6)
+                    if n % 2:
+                        filename += ".gz"
+                    if activity_id not in missing_ids:
+                        data = b"".join(self.gpx(activity_id))
+                        zf.writestr(filename, gzip.compress(data) if n % 2 else data)
+                writer.writerow([
+                    activity_id,
+                    a["start_date"].strftime("%b %d, %Y, %I:%M:%S %p"),
+                    a["name"],
+                    a["type"],
+                    a["elapsed_time"],
+                    filename,
+                    float(a["elapsed_time"]),
+                    a["distance"] / 1000,
+                ])
+            zf.writestr("activities.csv", listed.getvalue())
+        return missing_ids
+
+
+class FakeProtocol:
+    """Stands in for the stravalib protocol used for raw API requests"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, url, **kwargs):
+        if url == "/activities/{id}":
+            self.client.api_request("get_activity")
+            return self.client.athlete.detail(kwargs["id"])
+        elif url == "/activities/{id}/photos":
+            self.client.api_request("get_activity_photos")
+            return self.client.athlete.photos(kwargs["id"], self.client.photo_url)
+        raise ValueError("Unsupported URL '{}'".format(url))
+
+
+class FakeClient:
+    """Stands in for the stravaweblib WebClient
+
+    All API requests take `latency` seconds and report their usage of the
+    `rate_limits` quotas to the rate limiter the same way the API does. Once a
+    quota is exceeded, requests are throttled (the fake equivalent of a 429
+    response) until the window ends. Website requests take `web_latency`
+    seconds.
+    """
+
+    jwt = "header.payload.signature"
+
+    def __init__(self, athlete, stats, *, photo_url, latency=0, web_latency=0,
+                 rate_limiter=None, rate_limits=(10 ** 6, 10 ** 7), rate_windows=(900, 86400)):
+        self.athlete = athlete
+        self.stats = stats
+        self.photo_url = photo_url
+        self.latency = latency
+        self.web_latency = web_latency
+        self.rate_limiter = rate_limiter
+        self.rate_limits = rate_limits
+        self.rate_windows = rate_windows
+        self.protocol = FakeProtocol(self)
+
+        self._lock = threading.Lock()
+        self._usage = [[0, 0] for _ in rate_limits]  # [window number, usage]
+
+    def api_request(self, endpoint):
+        """Simulate an API request, retrying it if it's throttled"""
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire("api")
+            time.sleep(self.latency)
+            self.stats.request("api:" + endpoint)
+
+            now = time.time()
+            with self._lock:
+                for usage, window in zip(self._usage, self.rate_windows):
+                    if usage[0] != now // window:
+                        usage[:] = [now // window, 0]
+                    usage[1] += 1
+                usage = [u for _, u in self._usage]
+            throttled = any(u > limit for u, limit in zip(usage, self.rate_limits))
+
+            if self.rate_limiter:
+                self.rate_limiter.update({
+                    "X-RateLimit-Usage": ",".join(str(u) for u in usage),
+                    "X-RateLimit-Limit": ",".join(str(x) for x in self.rate_limits),
+                })
+            if not throttled:
+                return
+
+            self.stats.throttle()
+            if not self.rate_limiter:
+                raise RuntimeError("Rate limit exceeded")
+            self.rate_limiter.exhausted("api")
+
+    def get_activities(self, before=None, after=None, limit=None):
+        activities = sorted(self.athlete.activities.values(), key=lambda a: a["start_date"],
+                            reverse=after is None)
+        if after is not None:
+            activities = [a for a in activities if a["start_date"] > after]
+
+        # An extra request is needed to find out there are no more pages
+        for i in range(0, len(activities) + 1, PAGE_SIZE):
+            self.api_request("get_activities")
+            for a in activities[i:i + PAGE_SIZE]:
+                yield model.Activity.deserialize(self.athlete.summary(a["id"]), bind_client=self)
+
+    def get_athlete(self):
+        self.api_request("get_athlete")
+        return model.Athlete.deserialize({
+            "id": 1,
+            "bikes": [{"id": b, "name": b} for b in self.athlete.bikes],
+            "shoes": [{"id": s, "name": s} for s in self.athlete.shoes],
+        }, bind_client=self)
+
+    def get_gear(self, gear):
+        self.api_request("get_gear")
+        data = {"id": gear.id, "name": gear.id, "brand_name": "Brand", "model_name": "Model",
+                "description": "Synthetic gear {}".format(gear.id)}
+        if gear.id in self.athlete.bikes:
+            return model.Bike.deserialize(dict(data, frame_type=3))
+        return model.Shoe.deserialize(data)
+
+    def get_bike_components(self, bike_id):
+        time.sleep(self.web_latency)
+        self.stats.request("web:get_bike_components")
+        return [{"id": 1, "type": "Chain", "brand": "Brand", "model": "Model",
+                 "added": datetime.date(2020, 1, 1), "removed": None, "distance": 1000}]
+
+    def get_activity_data(self, activity_id, fmt=None, json_fmt=None):
+        time.sleep(self.web_latency)
+        self.stats.request("web:get_activity_data")
+        stats = self.stats
+
+        def content():
+            for chunk in self.athlete.gpx(activity_id):
+                stats.served(len(chunk))
+                yield chunk
+
+        return ExportFile(filename="{}.gpx".format(activity_id), content=content())
+
+
+class PhotoServer(http.server.ThreadingHTTPServer):
+    """Serves synthetic photos of `size` bytes on a local port
+
+    Supports range requests so interrupted downloads can be resumed.
+    """
+
+    daemon_threads = True
+    path_regex = re.compile(r"/photos/(\d+)/(\d+)\.jpg")
+
+    def __init__(self, stats, *, size=200 * 1024, latency=0):
+        super().__init__(("127.0.0.1", 0), PhotoHandler)
+        self.stats = stats
+        self.size = size
+        self.latency = latency
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def photo(self, activity_id, n):
+        size = self.size - 4
+        data = random.Random("{}-{}".format(activity_id, n)).getrandbits(8 * size).to_bytes(size, "little")
+        return b"\xff\xd8" + data + b"\xff\xd9"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+        self.server_close()
+
+
+class PhotoHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        m = self.server.path_regex.fullmatch(self.path)
+        if not m:
+            self.send_error(404)
+            return
+
+        time.sleep(self.server.latency)
+        data = self.server.photo(int(m.group(1)), int(m.group(2)))
+        status = 200
+        headers = {"Content-Type": "image/jpeg"}
+        range_ = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if range_:
+            offset = int(range_.group(1))
+            if offset >= len(data):
+                self.send_error(416)
+                return
+            status = 206
+            headers["Content-Range"] = "bytes {}-{}/{}".format(offset, len(data) - 1, len(data))
+            data = data[offset:]
+            self.server.stats.resume()
+
+        self.server.stats.request("photo", len(data))
+        self.send_response(status)
+        headers["Content-Length"] = str(len(data))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
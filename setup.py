@@ -32,5 +32,9 @@ setup(
         "stravalib>=0.10.4,<1.0.0",
         "commented-configparser>=2,<3",
     ],
+    extras_require={
+        "zstd": ["zstandard>=0.15"],
+        "tracks": ["numpy>=1.17", "fitparse>=1.2.0"],
+    },
     entry_points={'console_scripts': ["strava-backup=stravabackup.__main__:main"]}
 )
@@ -1,392 +1,413 @@
 #!/usr/bin/env python
 
-import base64
-from collections import defaultdict
-import datetime
+from collections import Counter, deque
+import concurrent.futures
+import contextlib
 import json
 import logging
 import os
 import re
-import sys
-
-import requests
-import stravalib
-from units import LeafUnit, ComposedUnit
-from units.quantity import Quantity
-
-from stravaweblib import WebClient, FrameType, DataFormat
-from stravalib.exc import AuthError
-
-
-__all__ = ["StravaBackup"]
+import shutil
+import zipfile
+
+from stravabackup.export import export_activities, stored_ext
+from stravabackup.index import Index, INDEX_FILENAME
+from stravabackup.scrub import scrub_file
+from stravabackup.storage import (
+    LAYOUTS, BlobStore, TreeStorage, check_compression, copy_files, open_compressed,
+    open_decompressed
+)
+from stravabackup.tracks import TRACK_EXTENSION, check_tracks, encode_track, track_path
+
+
+__all__ = [
+    "StravaBackup", "archive_status", "backfill_tracks", "convert_layout", "import_export",
+    "open_output_dir", "scrub_archive",
+]
 __log__ = logging.getLogger(__name__)
 
 TIME_FMT = "%Y-%m-%dT%H:%M:%SZ"
 TIME_FMT_FILE = "%Y-%m-%dT%H-%M-%SZ"
 
 META_EXTENSION = "meta.json"
+HISTORY_EXTENSION = "history.jsonl"
+ACTIVITY_DIR = "activities"
+PHOTO_DIR = "photos"
+GEAR_DIR = "gear"
+BLOB_DIR = "blobs"
 ACTIVITY_FILENAME = "{start}_{id}.{ext}"
 GEAR_FILENAME = "{id}.{ext}"
 PHOTO_FILENAME = "{activity_id}_{photo_id}.{ext}"
 ACTIVITY_REGEX = re.compile(r"[\dTZ-]*_(\d*)\..*")
 PHOTO_REGEX = re.compile(r"(\d*)_([\w-]*)\..*")
 
-PHOTO_SOURCES = {1: "Strava", 2: "Instagram"}
-
-
-def valid_unit(unit):
-    """A unit is valid if it uses meters, seconds, or a combination thereof"""
-    if isinstance(unit, LeafUnit):
-        return unit.specifier in ("m", "s")
-    elif isinstance(unit, ComposedUnit):
-        numer = unit.numer
-        denom = unit.denom
-        if len(numer) == len(denom) == 1:
-            return valid_unit(numer) and valid_unit(denom)
-    elif isinstance(unit, list):
-        # units can be a list of units (ex: m/s)
-        return all(valid_unit(x) for x in unit)
-    return False
-
-
-def photo_url(photo):
-    """Return the largest picture URL for the photo object"""
-    if not photo.urls:
-        return None
-    return photo.urls[sorted(photo.urls, key=int, reverse=True)[0]]
-
-
-def obj_to_json(obj):
-    """How to dump everything to JSON"""
-    if isinstance(obj, datetime.date):
-        return obj.strftime(TIME_FMT)
-    elif isinstance(obj, datetime.timedelta):
-        return obj.total_seconds()
-    elif isinstance(obj, Quantity) and valid_unit(obj.unit):
-        return obj.num
-    elif isinstance(obj, stravalib.model.Activity):
-        return {p: getattr(obj, p) for p in ("id", "name", "description",
-                                             "type", "commute", "trainer",
-                                             "distance", "start_date",
-                                             "moving_time", "elapsed_time",
-                                             "calories", "device_name",
-                                             "gear_id", "total_elevation_gain",
-                                             "average_speed", "max_speed")}
-    elif isinstance(obj, stravalib.model.Gear):
-        d = {p: getattr(obj, p) for p in ('id', 'name', 'brand_name',
-                                          'model_name', 'description')}
-        if hasattr(obj, 'components'):
-            d['components'] = obj.components
-        if isinstance(obj, stravalib.model.Bike):
-            d['frame_type'] = str(FrameType(obj.frame_type))
-        return d
-    elif isinstance(obj, stravalib.model.ActivityPhoto):
-        d = {p: getattr(obj, p) for p in ('activity_id', 'caption', 'location',
-                                          'created_at', 'uploaded_at')}
-        d['id'] = obj.unique_id or obj.id
-        d['source'] = PHOTO_SOURCES.get(obj.source)
-        d['url'] = photo_url(obj)
-        return d
-
-    raise ValueError("Can't serialize object: {!r}".format(obj))
-
-
-def json_dump(*args, **kwargs):
-    """Custom JSON dump that knows how to handle all the required formats"""
-    json.dump(*args, sort_keys=True, ensure_ascii=False, default=obj_to_json, **kwargs)
-
-
-class StravaBackup:
-    """Download your data from Strava"""
-
-    def __init__(self, *, access_token, email, password, jwt, out_dir):
-        self.out_dir = out_dir
-
-        if not access_token:
-            raise ValueError("An access_token is required")
-
-        self.client = self._make_client(access_token, email, password, self._validate_jwt(jwt))
-        self._have = self._find_existing_data()
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *_):
-        pass
-
-    @property
-    def activity_dir(self):
-        return os.path.join(self.out_dir, "activities")
-
-    @property
-    def photo_dir(self):
-        return os.path.join(self.out_dir, "photos")
-
-    @property
-    def gear_dir(self):
-        return os.path.join(self.out_dir, "gear")
-
-    @property
-    def jwt(self):
-        return self.client.jwt
-
-    @staticmethod
-    def _validate_jwt(jwt):
-        """Validate the JWT
-
-        Warns of the expiry time of a valid JWT.
-        Returns None if the JWT is invalid/expired.
-        """
-        if not jwt:
-            return None
 
-        try:
-            _, payload, _ = jwt.split('.')  # header.payload.signature
-            payload += "=" * (4 - len(payload) % 4)  # ensure correct padding
-            data = json.loads(base64.b64decode(payload, validate=True))
-            __log__.debug("JWT token data: %s", data)
-            expiry = datetime.datetime.fromtimestamp(data["exp"])
-        except Exception:
-            __log__.error("Failed to parse provided JWT '%s' - ignoring it", jwt, exc_info=True)
-            return None
-
-        now = datetime.datetime.now()
-        if expiry < now:
-            __log__.error("Provided JWT token expired on %s - ignoring it", expiry)
-            return None
-
-        __log__.info(
-            "Using a JWT token that will expire on %s (in %s)",
-            expiry,
-            expiry-now
-        )
-        return jwt
-
-    @staticmethod
-    def _make_client(access_token, email, password, jwt):
-        # attempt login via JWT
-        if jwt:
-            try:
-                return WebClient(
-                    access_token=access_token,
-                    jwt=jwt
-                )
-            except AuthError:
-                __log__.error("Failed to login with JWT", exc_info=True)
+def __getattr__(name):
+    # Importing the backup code pulls in the network libraries (slow) so only
+    # do it when it's actually used
+    if name == "StravaBackup":
+        from stravabackup.backup import StravaBackup
+        return StravaBackup
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-        if email and password:
-            # Attempt login using the email/password
-            try:
-                return WebClient(
-                    access_token=access_token,
-                    email=email,
-                    password=password,
-                )
-            except AuthError:
-                __log__.error("Failed to login with email + password", exc_info=True)
-
-        raise AuthError("Failed to log into account")
-
-    def _ensure_output_dirs(self, gear=True, photos=True):
-        os.makedirs(self.activity_dir, exist_ok=True)
-        if photos:
-            os.makedirs(self.photo_dir, exist_ok=True)
-        if gear:
-            os.makedirs(self.gear_dir, exist_ok=True)
-
-    def _find_existing_data(self):
-        """Look through the output dir for existing files"""
-        # layout is [meta, data, {photoid: [photo_meta, photo_data]}]
-
-        # Find existing activities
-        have = defaultdict(lambda: [False, False, defaultdict(lambda: [False, False])])
-        for _, _, filenames in os.walk(self.activity_dir):
-            for filename in filenames:
-                m = ACTIVITY_REGEX.match(filename)
-                if not m:
-                    continue
-                activity_id = int(m.group(1))
-                if filename.endswith("." + META_EXTENSION):
-                    have[activity_id][0] = True
-                else:
-                    have[activity_id][1] = True
-
-        # Find existing photos for activities
-        for _, _, filenames in os.walk(self.photo_dir):
-            for filename in filenames:
-                m = PHOTO_REGEX.match(filename)
-                if not m:
-                    continue
-                activity_id = int(m.group(1))
-                photo_id = m.group(2)
-                if filename.endswith("." + META_EXTENSION):
-                    have[activity_id][2][photo_id][0] = True
-                else:
-                    have[activity_id][2][photo_id][1] = True
-
-        return have
-
-    def _data_path(self, data, ext=META_EXTENSION):
-        """Return a file to save any given object into"""
-        if isinstance(data, stravalib.model.Activity):
-            filename = ACTIVITY_FILENAME.format(
-                start=data.start_date.strftime(TIME_FMT_FILE),
-                id=data.id,
-                ext=ext
-            )
-            path = os.path.join(self.activity_dir, str(data.start_date.year))
-        elif isinstance(data, stravalib.model.Gear):
-            filename = GEAR_FILENAME.format(
-                id=data.id,
-                ext=ext
-            )
-            path = self.gear_dir
-        elif isinstance(data, stravalib.model.ActivityPhoto):
-            filename = PHOTO_FILENAME.format(
-                activity_id=data.activity_id,
-                photo_id=data.unique_id or data.id,
-                ext=ext
-            )
-            path = self.photo_dir
-        else:
-            raise AssertionError("Unknown datatype '{}'".format(type(data)))
 
-        os.makedirs(path, exist_ok=True)
-        return os.path.join(path, filename)
+@contextlib.contextmanager
+def open_output_dir(out_dir, rescan=False, layout=None, dedup=False):
+    """Open the index and storage of an existing output directory
 
-    def _save_metadata(self, obj):
-        """Write the objects's metadata into the correct file"""
-        path = self._data_path(obj)
-        with open(path, "wt", encoding="utf8") as fp:
-            json_dump(obj, fp)
+    Doesn't require network access. The index is rebuilt from the files if
+    required (or a rescan is requested). If a `layout` is set, the output
+    directory is created with it if it doesn't exist yet.
+    """
+    if layout is None and not os.path.isdir(out_dir):
+        raise FileNotFoundError("Output directory '{}' doesn't exist".format(out_dir))
+    os.makedirs(out_dir, exist_ok=True)
 
-    def have_activity(self, activity, photos=True, metadata=True):
-        """Check if we have an activity (and all it's photos)"""
-        h = self._have[activity.id]
-
-        if metadata and not h[0]:
-            return False
-
-        if not h[1] and not activity.manual:
-            return False
-
-        if not photos:
-            return True
-
-        complete_photos = [k for k, v in h[2].items() if all(v)]
-        return len(complete_photos) >= activity.total_photo_count
-
-    def _activities(self):
-        i = self.client.get_activities()
+    index = Index(os.path.join(out_dir, INDEX_FILENAME))
+    try:
+        storage = open_storage(out_dir, index, layout=layout, dedup=dedup)
         try:
-            yield from i
-        except stravalib.exc.AccessUnauthorized:
-            __log__.error("Failed to list activities (missing activity:read scope?). Skipping.")
-
-    def backup_gear(self, dry_run=False):
-        athlete = self.client.get_athlete()
-        if athlete.bikes is None and athlete.shoes is None:
-            __log__.error("Failed to get gear data (missing profile:read_all scope?). Skipping.")
+            update_index(index, storage, rescan=rescan)
+            yield index, storage
+        finally:
+            storage.close()
+    finally:
+        index.close()
+
+
+def open_storage(out_dir, index, layout=None, dedup=False):
+    """Open the storage of an output directory using the layout in its index
+
+    An output directory without a layout is set up to use `layout` (or the
+    tree layout if it's not set). Files are deduplicated using the blob store
+    if `dedup` is set (only supported by the tree layout).
+    """
+    current = index.get_state("layout")
+    if current is None:
+        # Output directories from before layouts existed use the tree layout
+        if index.scanned or os.path.exists(os.path.join(out_dir, ACTIVITY_DIR)):
+            current = TreeStorage.layout
+        else:
+            current = layout or TreeStorage.layout
+        index.set_state("layout", current)
+
+    if current == TreeStorage.layout:
+        return TreeStorage(out_dir, blobs=BlobStore(os.path.join(out_dir, BLOB_DIR)) if dedup else None)
+    return LAYOUTS[current](out_dir)
+
+
+def update_index(index, storage, rescan=False):
+    """Bring the index of an output directory up to date with its files
+
+    The files are scanned if the index hasn't been populated yet or a rescan
+    is requested. The metadata of activities is indexed if it hasn't been.
+    """
+    if rescan or not index.scanned:
+        __log__.info("Scanning '%s' for existing data", storage.root)
+        index.replace_files(scan_files(storage))
+        index_metadata(index, storage)
+    elif not index.get_state("metadata_indexed"):
+        index_metadata(index, storage)
+
+
+def scan_files(storage):
+    """Look through the storage of an output dir for existing files
+
+    Yields (path, activity_id, photo_id, meta, size) for each file found.
+    Partially-downloaded files are ignored.
+    """
+    # Find existing activities
+    for path, size in storage.list(ACTIVITY_DIR):
+        filename = os.path.basename(path)
+        if filename.endswith("." + TRACK_EXTENSION):
+            continue
+        m = ACTIVITY_REGEX.match(filename)
+        if m:
+            yield path, int(m.group(1)), None, filename.endswith("." + META_EXTENSION), size
+
+    # Find existing photos for activities
+    for path, size in storage.list(PHOTO_DIR):
+        filename = os.path.basename(path)
+        m = PHOTO_REGEX.match(filename)
+        if m:
+            yield path, int(m.group(1)), m.group(2), filename.endswith("." + META_EXTENSION), size
+
+
+def index_metadata(index, storage):
+    """Rebuild the activity metadata in the index from the saved files"""
+    def load():
+        for path, _, photo_id, meta, _ in index.files():
+            if meta and photo_id is None:
+                try:
+                    yield json.loads(storage.read(path))
+                except (OSError, ValueError):
+                    __log__.warning("Failed to read metadata from '%s'", path, exc_info=True)
+
+    __log__.info("Indexing activity metadata")
+    index.add_activities(list(load()))
+    index.set_state("metadata_indexed", "1")
+
+
+def convert_layout(out_dir, layout):
+    """Convert an output directory to a different layout"""
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout '{}'".format(layout))
+
+    index = Index(os.path.join(out_dir, INDEX_FILENAME))
+    try:
+        current = index.get_state("layout", TreeStorage.layout)
+        if current == layout:
+            __log__.info("Output directory '%s' already uses the '%s' layout", out_dir, layout)
             return
 
-        bikes = athlete.bikes or []
-        shoes = athlete.shoes or []
+        src = LAYOUTS[current](out_dir)
+        if current == TreeStorage.layout:
+            # Ensure any deduplicated files are removed as well
+            src.blobs = BlobStore(os.path.join(out_dir, BLOB_DIR))
+        dest = LAYOUTS[layout](out_dir)
 
-        if dry_run:
-            __log__.info(
-                "Would download current gear data from %d bike(s) and %d shoe(s)",
-                len(bikes), len(shoes)
-            )
-            return
-
-        __log__.info(
-            "Downloading current gear data (%d bike(s) and %d shoe(s))",
-            len(bikes), len(shoes)
-        )
-
-        for gear in bikes + shoes:
-            obj = self.client.get_gear(gear)
-            if isinstance(obj, stravalib.model.Bike):
-                obj.components = self.client.get_bike_components(gear.id)
-            self._save_metadata(obj)
-
-    def backup_photos(self, activity_id, photo_data):
-        for p in self.client.get_activity_photos(activity_id,
-                                                 only_instagram=False,
-                                                 size=5000):
-            # unique_id for Strava, id for Instagram
-            photo_id = p.unique_id or p.id
-
-            if not photo_data[photo_id][0]:
-                self._save_metadata(p)
-
-            if not photo_data[photo_id][1]:
-                url = photo_url(p)
-                if not url:
-                    continue
-
-                __log__.info("Downloading photo %s", photo_id)
-                resp = requests.get(url, stream=True)
-                # TODO: Check for filetype instead of assuming jpg
-                with open(self._data_path(p, ext="jpg"), "wb") as f:
-                    f.writelines(resp.iter_content(chunk_size=16384))
-
-    def backup_activities(self, *, limit=None, metadata=True, photos=True, dry_run=False):
+        __log__.info("Converting '%s' from the '%s' layout to '%s'", out_dir, current, layout)
+        try:
+            relpaths = copy_files(src, dest, (ACTIVITY_DIR, PHOTO_DIR, GEAR_DIR))
+            index.set_state("layout", layout)
+            src.clear(relpaths)
+        finally:
+            src.close()
+            dest.close()
+        __log__.info("Converted %d file(s)", len(relpaths))
+    finally:
+        index.close()
+
+
+def backfill_tracks(out_dir, processes=None):
+    """Decode tracks from all original activity files that don't have one
+
+    The files are decoded in parallel using a pool of processes. Returns the
+    number of tracks that were added.
+    """
+    check_tracks()
+    processes = processes or os.cpu_count() or 1
+
+    with open_output_dir(out_dir) as (_, storage):
+        files = {p for p, _ in storage.list(ACTIVITY_DIR)}
+        todo = [
+            (p, track_path(p)) for p in sorted(files)
+            if track_path(p) and track_path(p) not in files
+        ]
+        if not todo:
+            __log__.info("All activities in '%s' already have tracks", out_dir)
+            return 0
+
+        __log__.info("Decoding tracks from %d activity file(s) in '%s'", len(todo), out_dir)
         count = 0
-        for a in self._activities():
-
-            if limit is not None and count >= limit:
-                return
+        pending = deque()
 
-            if self.have_activity(a, photos=photos, metadata=metadata):
-                continue
-
-            count += 1
-
-            have_meta, have_data, photo_data = self._have[a.id]
-
-            if dry_run:
-                if not a.manual and not have_data:
-                    __log__.info("Would download activity %s", a)
-                elif metadata and not have_meta:
-                    __log__.info("Would download metadata for activity %s", a)
+        def finish():
+            nonlocal count
+            path, dest, future = pending.popleft()
+            try:
+                storage.write(dest, future.result())
+                count += 1
+            except Exception:
+                __log__.warning("Failed to decode a track from '%s'", path, exc_info=True)
+
+        # The files are read and written in this process so any layout works.
+        # Limit how many are in memory at once.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            for path, dest in todo:
+                pending.append(
+                    (path, dest, pool.submit(encode_track, os.path.basename(path), storage.read(path)))
+                )
+                while len(pending) >= 2 * processes:
+                    finish()
+            while pending:
+                finish()
+
+        __log__.info("Added %d track(s)", count)
+        return count
+
+
+def scrub_archive(out_dir, processes=None, full=False):
+    """Check the integrity of all the files in an output directory
+
+    Files are hashed and checked in parallel using a pool of processes. Only
+    files that changed since the last scrub are checked unless `full` is set,
+    in which case files whose contents changed without being modified are
+    reported as well. Bad activity files and photos are queued to be
+    downloaded again by the next backup. Returns {path: problem} for all bad
+    files.
+    """
+    processes = processes or os.cpu_count() or 1
+
+    with open_output_dir(out_dir) as (index, storage):
+        known = index.checksums()
+        rows = []
+        todo = []
+        for top in (ACTIVITY_DIR, PHOTO_DIR, GEAR_DIR):
+            for path, size in storage.list(top):
+                mtime = storage.mtime(path)
+                prev = known.get(path)
+                if prev and not full and prev[:2] == (size, mtime):
+                    rows.append((path, size, mtime) + prev[2:])
+                else:
+                    todo.append((path, size, mtime))
 
-                if photos and a.total_photo_count:
-                    __log__.info("Would download %d photo(s) from activity %s", a.total_photo_count, a)
+        __log__.info("Scrubbing %d file(s) in '%s' (%d unchanged)", len(todo), out_dir, len(rows))
+        pending = deque()
 
+        def finish():
+            path, size, mtime, future = pending.popleft()
+            try:
+                sha256, problem = future.result()
+            except Exception:
+                # Don't record a checksum so it's checked again next time
+                __log__.warning("Failed to scrub '%s'", path, exc_info=True)
+                return
+            prev = known.get(path)
+            if not problem and prev and prev[:2] == (size, mtime) and prev[2] != sha256:
+                problem = "contents changed without being modified"
+            rows.append((path, size, mtime, sha256, problem))
+
+        # Files are hashed in place (memory-mapped) when they're stored in
+        # the tree layout. Otherwise they're read in this process, so limit
+        # how many are in memory at once.
+        local = storage.layout == TreeStorage.layout
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            for path, size, mtime in todo:
+                filename = os.path.basename(path)
+                if local:
+                    future = pool.submit(scrub_file, filename, path=storage.path(path))
+                else:
+                    future = pool.submit(scrub_file, filename, data=storage.read(path))
+                pending.append((path, size, mtime, future))
+                while len(pending) >= 2 * processes:
+                    finish()
+            while pending:
+                finish()
+
+        problems = {path: problem for path, _, _, _, problem in rows if problem}
+        files = {p: a for p, a, _, _, _ in index.files()}
+        index.replace_checksums(rows)
+        for path, problem in sorted(problems.items()):
+            __log__.warning("'%s' is bad: %s", path, problem)
+            # Forgetting the file makes the next backup download it again
+            if path in files:
+                index.remove_file(path)
+                index.queue_redownload(path, files[path], problem)
+
+        __log__.info("Scrubbed %d file(s), %d bad", len(rows), len(problems))
+        return problems
+
+
+def import_export(out_dir, export, *, layout=TreeStorage.layout, compress=None, dedup=False):
+    """Import the original activity files from a Strava bulk export ZIP
+
+    Each file is copied straight from the ZIP into the storage (nothing else
+    is extracted) and recorded in the index, so the next backup only
+    downloads the metadata, photos, and anything that isn't in the export.
+    Activities that already have an original file are skipped. Returns the
+    number of files that were imported.
+    """
+    check_compression(compress)
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout '{}'".format(layout))
+
+    with zipfile.ZipFile(export) as zf, \
+            open_output_dir(out_dir, layout=layout, dedup=dedup) as (index, storage):
+        have = {a for _, a, photo_id, meta, _ in index.files() if photo_id is None and not meta}
+        count = skipped = 0
+        for activity in export_activities(zf):
+            if activity.id in have:
+                skipped += 1
                 continue
 
-            need_photos = photos and a.total_photo_count
-            need_metadata =  metadata and not have_meta
-
-            # Get the fully-detailed activity for photos and metadata
-            if need_photos or need_metadata:
-                a = self.client.get_activity(a.id)
-
-            if need_photos:
-                __log__.info("Downloading %d photo(s) from activity %s", a.total_photo_count, a)
-                self.backup_photos(a.id, photo_data)
-
-            if need_metadata:
-                self._save_metadata(a)
-
-            if not a.manual and not have_data:
-                # Download the original activity from the website
-                data = self.client.get_activity_data(a.id,
-                                                     fmt=DataFormat.ORIGINAL,
-                                                     json_fmt=DataFormat.GPX)
-                ext = data.filename.rsplit(".", 1)[-1]
-
-                __log__.info("Downloading activity %s (%s)", a, data.filename)
-                with open(self._data_path(a, ext=ext), "wb") as f:
-                    f.writelines(data.content)
-
-    def run_backup(self, *, limit=None, metadata=True, gear=True, photos=True, dry_run=False):
-
-        if not dry_run:
-            self._ensure_output_dirs(gear=gear, photos=photos)
+            tmp = None
+            try:
+                ext, src, compress_with = stored_ext(activity.entry, compress)
+                path = os.path.join(
+                    ACTIVITY_DIR,
+                    str(activity.start_date.year),
+                    ACTIVITY_FILENAME.format(
+                        start=activity.start_date.strftime(TIME_FMT_FILE),
+                        id=activity.id,
+                        ext=ext
+                    )
+                )
+                tmp = storage.partial_path(path)
+                with zf.open(activity.entry) as f, open_compressed(tmp, compress_with) as out:
+                    shutil.copyfileobj(open_decompressed(f, src), out, 1024 * 1024)
+            except Exception:
+                __log__.warning("Failed to import activity %s from '%s'", activity.id,
+                                activity.entry, exc_info=True)
+                if tmp is not None:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(tmp)
+                continue
 
-        if gear:
-            self.backup_gear(dry_run=dry_run)
+            size = os.path.getsize(tmp)
+            storage.add(path, tmp)
+            index.add_file(path, activity.id, None, False, size)
+            index.remove_failure(activity.id)
+            have.add(activity.id)
+            count += 1
 
-        self.backup_activities(limit=limit, metadata=metadata, photos=photos, dry_run=dry_run)
+        __log__.info("Imported %d activity file(s) from '%s' (%d already backed up)",
+                     count, export, skipped)
+        return count
+
+
+def archive_status(out_dir, rescan=False):
+    """Summarize what has been backed up to an output directory
+
+    Only reads the local files so doesn't require network access.
+    """
+    with open_output_dir(out_dir, rescan=rescan) as (index, storage):
+        meta, data, photo_meta, photo_data = set(), set(), set(), set()
+        for _, activity_id, photo_id, is_meta, _ in index.files():
+            if photo_id is None:
+                (meta if is_meta else data).add(activity_id)
+            else:
+                (photo_meta if is_meta else photo_data).add((activity_id, photo_id))
+
+        # Photo counts and if activities are manual (no original file) are
+        # only known for activities backed up after they were indexed
+        photos = Counter(a for a, _ in photo_meta & photo_data)
+        missing_photos = {}
+        missing_data = []
+        for a in index.query_activities(fields=("id", "manual", "total_photo_count")):
+            if a["total_photo_count"] and photos[a["id"]] < a["total_photo_count"]:
+                missing_photos[a["id"]] = a["total_photo_count"] - photos[a["id"]]
+            if a["manual"] == 0 and a["id"] not in data:
+                missing_data.append(a["id"])
+
+        def activity(row):
+            return row and dict(zip(("id", "start_date", "name"), row))
+
+        oldest, newest = index.activity_range()
+        return {
+            "output_dir": out_dir,
+            "layout": storage.layout,
+            "activities": len(meta | data),
+            "activities_with_data": len(data),
+            "photos": sum(photos.values()),
+            "oldest": activity(oldest),
+            "newest": activity(newest),
+            "last_backup": index.get_state("last_backup"),
+            "last_full_sync": index.get_state("last_full_sync"),
+            "missing_photos": sum(missing_photos.values()),
+            "activities_missing_photos": sorted(missing_photos),
+            "activities_missing_data": missing_data,
+            "activities_missing_metadata": sorted(data - meta),
+            "incomplete_photos": sorted(
+                "{}_{}".format(*p) for p in photo_meta ^ photo_data
+            ),
+            "partial_files": sorted(
+                os.path.relpath(p, out_dir) for p in storage.partial_files()
+            ),
+            "failed_downloads": [
+                dict(activity_id=activity_id, photo_id=photo_id, reason=reason, attempts=attempts,
+                     next_attempt=next_attempt)
+                for (activity_id, photo_id), (reason, attempts, next_attempt)
+                in sorted(index.failures().items(), key=lambda x: (x[0][0], x[0][1] or ""))
+            ],
+        }
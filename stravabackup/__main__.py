@@ -1,21 +1,34 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import contextlib
+import csv
+import functools
 import io
+import json
 import logging
 import os
+import signal
 import sys
+import threading
 
 from commentedconfigparser import CommentedConfigParser
-from stravabackup import StravaBackup
-from stravalib import Client
+from stravabackup import (
+    archive_status, backfill_tracks, convert_layout, import_export, open_output_dir,
+    scrub_archive
+)
+from stravabackup.index import ACTIVITY_FIELDS, INDEX_FILENAME
+from stravabackup.metrics import Metrics, write_json, write_prometheus
+from stravabackup.storage import LAYOUTS
 
 
 __log__ = logging.getLogger(__name__)
 
 
 LOG_FORMAT = "%(asctime)s [%(levelname)8s] %(name)s: %(message)s"
+LOG_FORMAT_ACCOUNTS = "%(asctime)s [%(levelname)8s] (%(threadName)s) %(name)s: %(message)s"
+DEFAULT_ACCOUNT = "default"
 HOME = os.path.expanduser("~")
 CONFIG_FILE = os.path.join(
     os.environ.get('XDG_CONFIG_HOME', os.path.join(HOME, '.config')),
@@ -25,6 +38,10 @@ OUTPUT_DIR = os.path.join(
     os.environ.get('XDG_DATA_HOME', os.path.join(HOME, ".local", "share")),
     "strava-backup"
 )
+STATE_DIR = os.path.join(
+    os.environ.get('XDG_STATE_HOME', os.path.join(HOME, ".local", "state")),
+    "strava-backup"
+)
 
 
 @contextlib.contextmanager
@@ -44,28 +61,405 @@ def _manage_config(fp):
     # janky way to track updates - if set to true, the config will be rewritten
     config._updated = False
 
+    def save():
+        __log__.info("Config changed, attempting to update the config file")
+        s = io.StringIO()
+        config.write(s)
+        new_config = s.getvalue()
+        try:
+            if not can_write:
+                raise FileNotFoundError("Cannot rewrite config - input config was a non-file")
+            with open(path, 'wt') as f:
+                f.write(new_config)
+        except OSError:
+            __log__.warning(
+                "Failed to automatically update the config file - "
+                "please update it manually with the following contents:\n```%s\n```",
+                new_config,
+                exc_info=True
+            )
+        else:
+            __log__.info("Updated configuration file with new values!")
+        config._updated = False
+
+    # for long-running commands that can't wait until exiting to save changes
+    config._save = save
+
     try:
         yield config
     finally:
         if config._updated:
-            __log__.info("Config changed, attempting to update the config file")
-            s = io.StringIO()
-            config.write(s)
-            new_config = s.getvalue()
+            save()
+
+
+def _parse_rate_limit(value):
+    """Parse a "<15 minute limit>,<daily limit>" string"""
+    if not value:
+        return None
+    short, long = (int(x) for x in value.split(","))
+    return {"short": short, "long": long}
+
+
+def _accounts(config):
+    """Get the names of all the accounts in the config
+
+    The default account is configured using the [api] and [user] sections.
+    Other accounts use [api:<name>] and [user:<name>] sections.
+    """
+    accounts = []
+    if config.has_section("user"):
+        accounts.append(DEFAULT_ACCOUNT)
+    accounts.extend(
+        s.split(":", 1)[1] for s in config.sections() if s.startswith("user:")
+    )
+    return accounts
+
+
+def _account_section(config, account, section):
+    if account == DEFAULT_ACCOUNT:
+        return config[section]
+    return config["{}:{}".format(section, account)]
+
+
+def _state_dir(config):
+    return os.path.expanduser(config['global'].get('state_dir', STATE_DIR))
+
+
+def _output_dir(config, account):
+    output_dir = os.path.expanduser(config['global'].get('output_dir', OUTPUT_DIR))
+    if account == DEFAULT_ACCOUNT:
+        return output_dir
+
+    user = _account_section(config, account, "user")
+    if user.get('output_dir'):
+        return os.path.expanduser(user['output_dir'])
+
+    # Other accounts are saved beside the output dir of the default account
+    # (not inside it where they could clash with its data)
+    nested = os.path.join(output_dir, account)
+    if os.path.exists(os.path.join(nested, INDEX_FILENAME)):
+        __log__.warning(
+            "Account '%s' is saved inside the output directory of the default account. Move "
+            "'%s' to '%s' or set an output_dir for the account.",
+            account, nested, _sibling_output_dir(output_dir, account)
+        )
+        return nested
+    return _sibling_output_dir(output_dir, account)
+
+
+def _sibling_output_dir(output_dir, account):
+    return "{}-{}".format(os.path.normpath(output_dir), account)
+
+
+def _convert_account(config, account, args, rate_limiters, lock):
+    """Convert the output directory of an account to a different layout"""
+    with lock:
+        output_dir = _output_dir(config, account)
+    convert_layout(output_dir, args.layout)
+
+
+def _tracks_account(config, account, args, rate_limiters, lock):
+    """Decode tracks from the original activity files of an account"""
+    with lock:
+        output_dir = _output_dir(config, account)
+    backfill_tracks(output_dir, processes=args.processes)
+
+
+def _scrub_account(config, account, args, rate_limiters, lock):
+    """Check the integrity of the files backed up for an account"""
+    with lock:
+        output_dir = _output_dir(config, account)
+    problems = scrub_archive(output_dir, processes=args.processes, full=args.full)
+    if problems:
+        raise ValueError(
+            "Found {} bad file(s) in '{}' (queued to be downloaded again where possible)"
+            "".format(len(problems), output_dir)
+        )
+
+
+def _import_account(config, account, args, rate_limiters, lock):
+    """Import the original activity files from a Strava export into an account's backup"""
+    with lock:
+        output_dir = _output_dir(config, account)
+        compress = config['global'].get('compress') or None
+        dedup = config['global'].getboolean('dedup', False)
+        layout = config['global'].get('layout', "tree")
+    import_export(output_dir, args.export, layout=layout, compress=compress, dedup=dedup)
+
+
+class _RowWriter:
+    """Write rows (dicts) to a file as CSV or JSONL"""
+
+    def __init__(self, fp, fmt, fields):
+        self.fp = fp
+        self.fmt = fmt
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.DictWriter(fp, fieldnames=fields)
+            self._csv.writeheader()
+
+    def write(self, row):
+        if self._csv:
+            self._csv.writerow(row)
+        else:
+            self.fp.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def _query_account(config, account, args, rate_limiters, lock):
+    """Output the metadata of the account's activities"""
+    with lock:
+        output_dir = _output_dir(config, account)
+
+    with open_output_dir(output_dir) as (index, _):
+        rows = index.query_activities(
+            type=args.type,
+            gear_id=args.gear,
+            after=args.after,
+            before=args.before,
+            fields=args.fields,
+        )
+        for row in rows:
+            if args.query_accounts:
+                row = dict(account=account, **row)
+            with lock:
+                args.writer.write(row)
+
+
+def _status_account(config, account, args, rate_limiters, lock):
+    """Output a summary of what has been backed up for an account"""
+    with lock:
+        output_dir = _output_dir(config, account)
+
+    status = archive_status(output_dir, rescan=args.rescan)
+    if args.json:
+        with lock:
+            print(json.dumps(dict(status, account=account)))
+        return
+
+    def activity(a):
+        if not a:
+            return "-"
+        return "{} - {} ({})".format(a["start_date"], a["name"], a["id"])
+
+    lines = [
+        "Account '{}' ({}, {} layout)".format(account, status["output_dir"], status["layout"]),
+        "  Activities: {} ({} with original files)".format(
+            status["activities"], status["activities_with_data"]
+        ),
+        "  Photos: {}".format(status["photos"]),
+        "  Oldest activity: {}".format(activity(status["oldest"])),
+        "  Newest activity: {}".format(activity(status["newest"])),
+        "  Last backup: {} (last full sync: {})".format(
+            status["last_backup"] or "never", status["last_full_sync"] or "never"
+        ),
+        "  Missing photos: {} (from {} activities)".format(
+            status["missing_photos"], len(status["activities_missing_photos"])
+        ),
+        "  Activities missing original files: {}".format(len(status["activities_missing_data"])),
+        "  Activities missing metadata: {}".format(len(status["activities_missing_metadata"])),
+        "  Incomplete photos: {}".format(len(status["incomplete_photos"])),
+        "  Partially-downloaded files: {}".format(len(status["partial_files"])),
+        "  Failed downloads: {} ({} given up on)".format(
+            len(status["failed_downloads"]),
+            sum(1 for f in status["failed_downloads"] if f["next_attempt"] is None)
+        ),
+    ]
+    with lock:
+        print("\n".join(lines))
+
+
+def _refresh_access_token(config, account, lock, session):
+    """Use the refresh token of an account to get a new access token
+
+    The config is updated if the refresh token changed. The new access token
+    is cached in the session. Returns the (access token, expiry time).
+    """
+    from stravalib import Client
+
+    with lock:
+        api = _account_section(config, account, "api")
+        client_id = api['client_id']
+        client_secret = api['client_secret']
+        refresh_token = api['refresh_token']
+
+    __log__.info("Using the refresh token to get an access token")
+    tokens = Client().refresh_access_token(client_id, client_secret, refresh_token)
+    if tokens['refresh_token'] != refresh_token:
+        __log__.info("Refresh token has changed, will attempt to update the config file")
+        with lock:
+            api['refresh_token'] = tokens['refresh_token']
+            config._updated = True
+    session.set_tokens(tokens)
+    return tokens['access_token'], tokens['expires_at']
+
+
+def _backup_options(args):
+    """Get the options for backing up an account from the arguments"""
+    return {
+        "limit": args.limit,
+        "metadata": not args.no_meta,
+        "gear": not args.no_gear,
+        "photos": not args.no_photos,
+        "dry_run": args.dry_run,
+        "full_sync": args.full_sync,
+        "workers": max(args.workers, 1),
+        "order": args.order,
+        "time_budget": args.time_budget * 60 if args.time_budget else None,
+    }
+
+
+def _login(config, account, args, rate_limiters, lock, token_lifetime=None):
+    """Log into an account from the config
+
+    The access token and web session are reused from previous runs if
+    they're still valid. The cached access token is only used if it will be
+    valid for `token_lifetime` more seconds (never if it's None) since it
+    isn't refreshed during a backup. Returns the (not yet started) backup,
+    the session cache of the account, and when the access token expires.
+    """
+    # The network libraries are slow to import so only do it when required
+    from stravalib.exc import AccessUnauthorized
+    from stravabackup.backup import StravaBackup
+    from stravabackup.ratelimit import RateLimiter
+    from stravabackup.session import SessionCache
+
+    with lock:
+        api = _account_section(config, account, "api")
+        user = _account_section(config, account, "user")
+
+        client_id = api['client_id']
+        email = user['email']
+        password = user['password']
+
+        output_dir = _output_dir(config, account)
+        compress = config['global'].get('compress') or None
+        dedup = config['global'].getboolean('dedup', False)
+        layout = config['global'].get('layout', "tree")
+        tracks = config['global'].getboolean('tracks', False)
+
+        # API rate limits are per-application so share the state between
+        # all accounts and runs using the same client_id
+        if client_id not in rate_limiters:
+            rate_limiters[client_id] = RateLimiter(
+                state_file=os.path.join(_state_dir(config), "ratelimit-{}.json".format(client_id)),
+                web_limits=_parse_rate_limit(config['global'].get('web_rate_limit')),
+            )
+        rate_limiter = rate_limiters[client_id]
+
+        session = SessionCache(
+            os.path.join(_state_dir(config), "session-{}.json".format(account)),
+            client_id, api['refresh_token'],
+        )
+        # The JWT in the config is only used until there's a newer one
+        jwt = session.jwt or user.get('jwt')
+
+    def login(access_token):
+        return StravaBackup(
+            access_token=access_token,
+            email=email,
+            password=password,
+            jwt=jwt,
+            out_dir=output_dir,
+            rescan=args.rescan,
+            rate_limiter=rate_limiter,
+            compress=compress,
+            dedup=dedup,
+            layout=layout,
+            tracks=tracks,
+            metrics=args.metrics[account],
+        )
+
+    cached = None if token_lifetime is None else session.access_token(token_lifetime)
+    if cached:
+        __log__.info("Using the cached access token")
+        access_token, expires_at = cached
+        try:
+            sb = login(access_token)
+        except AccessUnauthorized:
+            __log__.warning("The cached access token was rejected, getting a new one")
+            # Don't use it again even if getting a new one fails
+            session.clear_access_token()
+            cached = None
+    if not cached:
+        access_token, expires_at = _refresh_access_token(config, account, lock, session)
+        sb = login(access_token)
+
+    if sb.jwt != jwt:
+        __log__.info("JWT token has changed, saving it for the next run")
+        session.jwt = sb.jwt
+
+    if args.dry_run:
+        __log__.info("Logged in, would backup '%s' to '%s'", email, output_dir)
+    else:
+        __log__.info("Logged in, backing up '%s' to '%s'", email, output_dir)
+    return sb, session, expires_at
+
+
+def _run_account(config, account, args, rate_limiters, lock):
+    """Back up a single account from the config"""
+    threading.current_thread().name = account
+
+    # The backup can't refresh the access token so it has to last until the
+    # time budget runs out (with no budget, get a new one)
+    token_lifetime = args.time_budget * 60 if args.time_budget else None
+    sb, _, _ = _login(config, account, args, rate_limiters, lock, token_lifetime=token_lifetime)
+    with sb:
+        sb.run_backup(**_backup_options(args))
+
+
+def _terminate(*_):
+    raise KeyboardInterrupt()
+
+
+def _run_daemon(config, accounts, args, rate_limiters, lock):
+    """Keep the accounts backed up using the events of a Strava push subscription"""
+    from stravabackup.daemon import Daemon
+
+    def refresher(account, session):
+        def refresh():
+            tokens = _refresh_access_token(config, account, lock, session)
+            # Don't wait until exiting to save a new refresh token
+            with lock:
+                if config._updated:
+                    config._save()
+            return tokens
+        return refresh
+
+    with lock:
+        verify_token = config['global']['webhook_verify_token']
+    daemon = Daemon((args.host, args.port), verify_token, metrics_file=args.metrics_file,
+                    prometheus_textfile=args.prometheus_textfile)
+    try:
+        for account in accounts:
             try:
-                if not can_write:
-                    raise FileNotFoundError("Cannot rewrite config - input config was a non-file")
-                with open(path, 'wt') as f:
-                    f.write(new_config)
-            except OSError:
-                __log__.warning(
-                    "Failed to automatically update the config file - "
-                    "please update it manually with the following contents:\n```%s\n```",
-                    new_config,
-                    exc_info=True
-                )
-            else:
-                __log__.info("Updated configuration file with new values!")
+                # The daemon refreshes the access token before it expires
+                sb, session, expires_at = _login(config, account, args, rate_limiters, lock,
+                                                 token_lifetime=0)
+            except Exception:
+                __log__.exception("Failed to log into account '%s'", account)
+                continue
+            try:
+                daemon.add_account(account, sb, refresher(account, session), expires_at,
+                                   options=_backup_options(args),
+                                   sync_interval=args.sync_interval * 3600 or None,
+                                   on_login=functools.partial(setattr, session, "jwt"))
+            except Exception:
+                __log__.exception("Failed to get the athlete of account '%s'", account)
+                sb.__exit__(None, None, None)
+        if not daemon.workers:
+            __log__.error("Failed to log into any accounts")
+            return 1
+
+        # Shut down cleanly when stopped by a service manager
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            __log__.info("Stopping")
+    finally:
+        daemon.close()
+        for rate_limiter in rate_limiters.values():
+            rate_limiter.save()
 
 
 def main():
@@ -75,9 +469,25 @@ def main():
     parser.add_argument("--config", nargs="?", type=argparse.FileType('rt'),
                         default=CONFIG_FILE,
                         help="The config file to use (default: %(default)s)")
+    parser.add_argument("--account", action="append", default=None,
+                        help="Only back up the named account (can be specified "
+                             "multiple times, default: all accounts)")
+    parser.add_argument("--max-accounts", type=int, default=1,
+                        help="The maximum number of accounts to back up in "
+                             "parallel (default: %(default)s)")
     parser.add_argument("--limit", nargs="?", type=int, default=None,
                         help="The maximum number of activities to back up in "
                              "a single run (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of activities to download in parallel "
+                             "(default: %(default)s)")
+    parser.add_argument("--time-budget", type=float, default=None, metavar="MINUTES",
+                        help="Stop before the backup has run for this long. The next "
+                             "run continues where it stopped (default: no limit)")
+    parser.add_argument("--order", choices=("newest", "oldest", "smallest"), default=None,
+                        help="The order to back up activities in. 'smallest' estimates the "
+                             "size from the number of photos and the elapsed time "
+                             "(default: the order they're listed by Strava)")
     parser.add_argument("--no-meta", action="store_true", default=False,
                         help="Don't download activity metadata")
     parser.add_argument("--no-gear", action="store_true", default=False,
@@ -86,63 +496,171 @@ def main():
                         help="Don't download the photos attached to activities")
     parser.add_argument("--dry-run", action="store_true", default=False,
                         help="Only list what would be downloaded")
+    parser.add_argument("--full-sync", action="store_true", default=False,
+                        help="Check all activities instead of only ones newer "
+                             "than the last backup")
+    parser.add_argument("--rescan", action="store_true", default=False,
+                        help="Rebuild the index of existing data by scanning "
+                             "the output directory")
+    parser.add_argument("--metrics", dest="metrics_file", default=None, metavar="FILE",
+                        help="Write a JSON summary of what each backup did and "
+                             "how long it took to a file")
+    parser.add_argument("--prometheus-textfile", default=None, metavar="FILE",
+                        help="Write the metrics of the backups to a file for the "
+                             "Prometheus node exporter's textfile collector")
     parser.add_argument("--quiet", action="store_true", default=False,
                         help="Don't output informational messages "
                              "(default: %(default)s)")
     parser.add_argument("--debug", action="store_true", default=False,
                         help="Output debug information (default: %(default)s)")
+    parser.set_defaults(func=_run_account)
+
+    subparsers = parser.add_subparsers(
+        title="commands", metavar="COMMAND",
+        description="Run a command instead of backing up the account(s)",
+    )
+    convert_parser = subparsers.add_parser(
+        "convert", help="Convert the output directory to a different layout"
+    )
+    convert_parser.add_argument("layout", choices=sorted(LAYOUTS),
+                                help="The layout to convert to")
+    convert_parser.set_defaults(func=_convert_account)
+
+    query_parser = subparsers.add_parser(
+        "query", help="Output the metadata of backed up activities"
+    )
+    query_parser.add_argument("--type", help="Only output activities of this type (ex: Ride)")
+    query_parser.add_argument("--gear", help="Only output activities using this gear id")
+    query_parser.add_argument("--after",
+                              help="Only output activities that started on or after "
+                                   "this (UTC) time (ex: 2020, 2020-03-01T12:00)")
+    query_parser.add_argument("--before",
+                              help="Only output activities that started before this (UTC) time")
+    query_parser.add_argument("--fields", type=lambda x: x.split(","), default=None,
+                              help="Comma-separated fields to output (default: {}). When "
+                                   "querying several accounts, the account is output first"
+                                   "".format(",".join(ACTIVITY_FIELDS)))
+    query_parser.add_argument("--format", choices=("csv", "jsonl"), default="csv",
+                              help="The output format (default: %(default)s)")
+    query_parser.set_defaults(func=_query_account)
+
+    tracks_parser = subparsers.add_parser(
+        "tracks", help="Decode tracks from original activity files that don't have one"
+    )
+    tracks_parser.add_argument("--processes", type=int, default=None,
+                               help="The number of files to decode in parallel "
+                                    "(default: the number of CPUs)")
+    tracks_parser.set_defaults(func=_tracks_account)
+
+    scrub_parser = subparsers.add_parser(
+        "scrub", help="Check the integrity of backed up files (doesn't require network access)"
+    )
+    scrub_parser.add_argument("--processes", type=int, default=None,
+                              help="The number of files to check in parallel "
+                                   "(default: the number of CPUs)")
+    scrub_parser.add_argument("--full", action="store_true", default=False,
+                              help="Check all files, not only ones that changed since the "
+                                   "last scrub")
+    scrub_parser.set_defaults(func=_scrub_account)
+
+    import_parser = subparsers.add_parser(
+        "import-export", help="Import the original activity files from a Strava bulk export "
+                              "(doesn't require network access)"
+    )
+    import_parser.add_argument("export", help="The ZIP file of the export")
+    import_parser.set_defaults(func=_import_account)
+
+    daemon_parser = subparsers.add_parser(
+        "daemon", help="Keep running and back up activities as Strava push subscription "
+                       "events are received"
+    )
+    daemon_parser.add_argument("--host", default="127.0.0.1",
+                               help="The address to receive events on (default: %(default)s)")
+    daemon_parser.add_argument("--port", type=int, default=8080,
+                               help="The port to receive events on (default: %(default)s)")
+    daemon_parser.add_argument("--sync-interval", type=float, default=24,
+                               help="How often to run an incremental backup to catch missed "
+                                    "events, in hours (0 to disable, default: %(default)s)")
+    daemon_parser.set_defaults(func=_run_daemon)
+
+    status_parser = subparsers.add_parser(
+        "status", help="Summarize what has been backed up (doesn't require network access)"
+    )
+    status_parser.add_argument("--json", action="store_true", default=False,
+                               help="Output the summary of each account as a line of JSON")
+    status_parser.set_defaults(func=_status_account)
+
     args = parser.parse_args()
 
+    if args.func is _query_account:
+        unknown = set(args.fields or ()) - set(ACTIVITY_FIELDS)
+        if unknown:
+            parser.error("Unknown field(s): {}".format(", ".join(sorted(unknown))))
+
     # Reduce logspam
     logging.getLogger("stravalib.model").setLevel(logging.INFO)
     logging.getLogger("stravalib.attributes").setLevel(logging.ERROR)
     logging.getLogger("stravaweblib.model").setLevel(logging.INFO)
-    logging.basicConfig(format=LOG_FORMAT,
+    logging.basicConfig(format=LOG_FORMAT_ACCOUNTS if args.max_accounts > 1 else LOG_FORMAT,
                         level=logging.DEBUG if args.debug else
                               logging.ERROR if args.quiet else logging.INFO)
 
     with _manage_config(args.config) as config:
-        client_id = config['api']['client_id']
-        client_secret = config['api']['client_secret']
-        refresh_token = config['api']['refresh_token']
-        output_dir = os.path.expanduser(config['global'].get('output_dir', OUTPUT_DIR))
-        email = config['user']['email']
-        password = config['user']['password']
-        jwt = config['user'].get('jwt')
-
-        __log__.info("Using the refresh token to get an access token")
-        tokens = Client().refresh_access_token(client_id, client_secret, refresh_token)
-        if tokens['refresh_token'] != refresh_token:
-            __log__.info("Refresh token has changed, will attempt to update the config file")
-            config['api']['refresh_token'] = refresh_token
-            config._updated = True
+        accounts = _accounts(config)
+        if args.account:
+            unknown = set(args.account) - set(accounts)
+            if unknown:
+                parser.error("Unknown account(s): {}".format(", ".join(sorted(unknown))))
+            accounts = [a for a in accounts if a in args.account]
+        if args.func is _import_account and len(accounts) != 1:
+            parser.error("An export can only be imported into one account (see --account)")
+        if args.func is _query_account:
+            # Say which account each activity is from when querying several
+            args.query_accounts = len(accounts) > 1
+            args.writer = _RowWriter(
+                sys.stdout, args.format,
+                (["account"] if args.query_accounts else []) + (args.fields or list(ACTIVITY_FIELDS))
+            )
 
-        access_token = tokens['access_token']
+        rate_limiters = {}
+        lock = threading.Lock()
+        args.metrics = {account: Metrics() for account in accounts}
+        if args.func is _run_daemon:
+            if not config['global'].get('webhook_verify_token'):
+                parser.error("The daemon requires a webhook_verify_token in the [global] section "
+                             "of the config")
+            return _run_daemon(config, accounts, args, rate_limiters, lock)
 
-        sb = StravaBackup(
-            access_token=access_token,
-            email=email,
-            password=password,
-            jwt=jwt,
-            out_dir=output_dir,
-        )
-        if sb.jwt != jwt:
-            __log__.info("JWT token has changed, will attempt to update the config file")
-            config['user']['jwt'] = sb.jwt
-            config._updated = True
+        # Handle each account in its own thread so failures are isolated
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.max_accounts, 1)) as pool:
+            futures = {
+                pool.submit(args.func, config, account, args, rate_limiters, lock): account
+                for account in accounts
+            }
+            for future in concurrent.futures.as_completed(futures):
+                account = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    __log__.exception("Failed to process account '%s'", account)
+                    failed.append(account)
+                    args.metrics[account].finish(success=False)
+                else:
+                    args.metrics[account].finish()
 
-    if args.dry_run:
-        __log__.info("Logged in, would backup '%s' to '%s'", email, output_dir)
-    else:
-        __log__.info("Logged in, backing up '%s' to '%s'", email, output_dir)
+        for rate_limiter in rate_limiters.values():
+            rate_limiter.save()
 
-    return sb.run_backup(
-        limit=args.limit,
-        metadata=not args.no_meta,
-        gear=not args.no_gear,
-        photos=not args.no_photos,
-        dry_run=args.dry_run
-    )
+        if args.func is _run_account:
+            if args.metrics_file:
+                write_json(args.metrics_file, args.metrics)
+            if args.prometheus_textfile:
+                write_prometheus(args.prometheus_textfile, args.metrics)
+
+    if failed:
+        __log__.error("Failed to process %d of %d account(s)", len(failed), len(accounts))
+        return 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1191 @@
+import base64
+from collections import defaultdict, deque, namedtuple
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import operator
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+import stravalib
+from units import LeafUnit, ComposedUnit
+from units.quantity import Quantity
+
+from stravaweblib import WebClient, FrameType, DataFormat
+from stravalib.exc import AuthError
+
+from stravabackup import (
+    ACTIVITY_DIR, ACTIVITY_FILENAME, BLOB_DIR, GEAR_DIR, GEAR_FILENAME, HISTORY_EXTENSION,
+    INDEX_FILENAME, META_EXTENSION, PHOTO_DIR, PHOTO_FILENAME, TIME_FMT, TIME_FMT_FILE, open_storage,
+    update_index
+)
+from stravabackup.index import Index
+from stravabackup.metrics import Metrics
+from stravabackup.ratelimit import RateLimitedSession
+from stravabackup.storage import (
+    LAYOUTS, PackedStorage, TreeStorage, check_compression, compressed_ext,
+    open_compressed
+)
+from stravabackup.tracks import check_tracks, encode_track, track_path
+
+
+__log__ = logging.getLogger(__name__)
+
+PHOTO_SOURCES = {1: "Strava", 2: "Instagram"}
+
+# Fields of a summary activity that invalidate the cached API responses for
+# the activity when they change
+CACHE_FINGERPRINT_FIELDS = ("name", "type", "distance", "moving_time", "elapsed_time",
+                            "manual", "private", "gear_id", "total_photo_count")
+
+# Photos are downloaded in parallel using a shared pool of connections
+PHOTO_WORKERS = 8
+PHOTO_CONNECTIONS_PER_HOST = 4
+
+# The number of gear items to request in parallel
+GEAR_WORKERS = 4
+
+
+def _estimated_size(activity):
+    """Estimate how much has to be downloaded for an activity from its summary
+
+    Photos are much larger than original files, which grow with the time
+    the activity was recorded for.
+    """
+    return (activity.total_photo_count or 0, activity.elapsed_time or datetime.timedelta())
+
+
+# The orders activities can be backed up in: (key, reverse). By default, they
+# are backed up in the order they are listed by the API.
+ACTIVITY_ORDERS = {
+    "newest": (operator.attrgetter("start_date"), True),
+    "oldest": (operator.attrgetter("start_date"), False),
+    "smallest": (_estimated_size, False),
+}
+
+# A completed download that is waiting to be moved from its partial path into
+# the storage at `path` and is `size` bytes
+Download = namedtuple("Download", ("path", "size"))
+
+# The data downloaded for an activity that needs to be saved
+#  - activity: the (detailed, if required) activity
+#  - metadata: if the activity metadata should be saved
+#  - photos: list of (photo, metadata, Download or None) tuples for photos to save
+#  - data: a Download of the original activity data (or None)
+#  - track: the encoded track decoded from the original activity data (or None)
+#  - failures: list of (photo_id, exception) tuples for the photos (or the
+#    original activity data if photo_id is None) that failed to download
+ActivityDownload = namedtuple("ActivityDownload",
+                              ("activity", "metadata", "photos", "data", "track", "failures"))
+
+# Activities that start up to this long before the newest backed up activity
+# are still listed by incremental runs (catches activities uploaded late)
+CURSOR_OVERLAP = datetime.timedelta(days=7)
+
+# How often to list all activities to catch edits and gaps
+FULL_SYNC_INTERVAL = datetime.timedelta(days=30)
+
+# Activities and photos that fail to download are retried after this long,
+# doubling after each failed attempt (up to MAX_RETRY_DELAY)
+RETRY_DELAY = datetime.timedelta(hours=1)
+MAX_RETRY_DELAY = datetime.timedelta(days=30)
+
+# Give up on downloading something after it failed this many times
+MAX_ATTEMPTS = 10
+
+# HTTP status codes that mean something will never be downloadable
+GONE_STATUS_CODES = (404, 410)
+
+# Errors that aren't caused by the activity being downloaded (retrying other
+# activities would fail the same way)
+FATAL_ERRORS = (AuthError, stravalib.exc.AccessUnauthorized, stravalib.exc.RateLimitExceeded)
+
+# Stop a backup when this many activities fail in a row since the problem
+# probably isn't with the activities (ex: the network is down)
+MAX_CONSECUTIVE_FAILURES = 5
+
+
+def valid_unit(unit):
+    """A unit is valid if it uses meters, seconds, or a combination thereof"""
+    if isinstance(unit, LeafUnit):
+        return unit.specifier in ("m", "s")
+    elif isinstance(unit, ComposedUnit):
+        numer = unit.numer
+        denom = unit.denom
+        if len(numer) == len(denom) == 1:
+            return valid_unit(numer) and valid_unit(denom)
+    elif isinstance(unit, list):
+        # units can be a list of units (ex: m/s)
+        return all(valid_unit(x) for x in unit)
+    return False
+
+
+# Units are interned so there are only ever a handful of them
+_VALID_UNITS = {}
+
+
+def _valid_unit_cached(unit):
+    try:
+        return _VALID_UNITS[unit]
+    except KeyError:
+        valid = _VALID_UNITS[unit] = valid_unit(unit)
+        return valid
+    except TypeError:
+        # unhashable (ex: a list of units)
+        return valid_unit(unit)
+
+
+def _failure_status(exc):
+    """Get the HTTP status code of a failed request (None if unknown)"""
+    response = getattr(exc, "response", None)
+    if response is not None:
+        return response.status_code
+    # The website client only includes the status code in the message
+    match = re.search(r"Status code '(\d+)'", str(exc))
+    return int(match.group(1)) if match else None
+
+
+def photo_url(photo):
+    """Return the largest picture URL for the photo object"""
+    if not photo.urls:
+        return None
+    return photo.urls[sorted(photo.urls, key=int, reverse=True)[0]]
+
+
+ACTIVITY_JSON_FIELDS = ("id", "name", "description", "type", "commute", "trainer",
+                       "distance", "start_date", "moving_time", "elapsed_time",
+                       "calories", "device_name", "gear_id", "total_elevation_gain",
+                       "average_speed", "max_speed")
+GEAR_JSON_FIELDS = ("id", "name", "brand_name", "model_name", "description", "distance")
+PHOTO_JSON_FIELDS = ("activity_id", "caption", "location", "created_at", "uploaded_at")
+
+
+def _fields_to_json(fields):
+    """Make a function that gets the fields of an object as a dict"""
+    getter = operator.attrgetter(*fields)
+    return lambda obj: dict(zip(fields, getter(obj)))
+
+
+_activity_fields_to_json = _fields_to_json(ACTIVITY_JSON_FIELDS)
+_gear_fields_to_json = _fields_to_json(GEAR_JSON_FIELDS)
+_photo_fields_to_json = _fields_to_json(PHOTO_JSON_FIELDS)
+_fingerprint_fields = operator.attrgetter(*CACHE_FINGERPRINT_FIELDS)
+
+
+def _quantity_to_json(obj):
+    if not _valid_unit_cached(obj.unit):
+        raise ValueError("Can't serialize object: {!r}".format(obj))
+    return obj.num
+
+
+def _gear_to_json(obj):
+    d = _gear_fields_to_json(obj)
+    if hasattr(obj, 'components'):
+        d['components'] = obj.components
+    if isinstance(obj, stravalib.model.Bike):
+        d['frame_type'] = str(FrameType(obj.frame_type))
+    return d
+
+
+def _photo_to_json(obj):
+    d = _photo_fields_to_json(obj)
+    d['id'] = obj.unique_id or obj.id
+    d['source'] = PHOTO_SOURCES.get(obj.source)
+    d['url'] = photo_url(obj)
+    return d
+
+
+# How to convert each type of object to JSON. When checking an object, the
+# first matching type is used.
+JSON_CONVERTERS = (
+    (datetime.date, lambda obj: obj.strftime(TIME_FMT)),
+    (datetime.timedelta, lambda obj: obj.total_seconds()),
+    (Quantity, _quantity_to_json),
+    (stravalib.model.Activity, _activity_fields_to_json),
+    (stravalib.model.Gear, _gear_to_json),
+    (stravalib.model.ActivityPhoto, _photo_to_json),
+)
+
+# The converter for each type that has been serialized
+_JSON_CONVERTER_CACHE = {}
+
+
+def _json_converter(cls):
+    for type_, converter in JSON_CONVERTERS:
+        if issubclass(cls, type_):
+            return converter
+    return None
+
+
+def obj_to_json(obj):
+    """How to dump everything to JSON"""
+    cls = type(obj)
+    try:
+        converter = _JSON_CONVERTER_CACHE[cls]
+    except KeyError:
+        converter = _JSON_CONVERTER_CACHE[cls] = _json_converter(cls)
+    if converter is None:
+        raise ValueError("Can't serialize object: {!r}".format(obj))
+    return converter(obj)
+
+
+# Reusing encoders avoids creating one for each call. Encoding everything in
+# one shot uses the C implementation of the encoder (`json.dump` doesn't).
+_FINGERPRINT_ENCODER = json.JSONEncoder(default=obj_to_json)
+_JSON_ENCODER = json.JSONEncoder(sort_keys=True, ensure_ascii=False, default=obj_to_json)
+
+
+def activity_fingerprint(activity):
+    """Get a string that changes when the activity summary does"""
+    return _FINGERPRINT_ENCODER.encode(list(_fingerprint_fields(activity)))
+
+
+def json_dump(obj, fp, **kwargs):
+    """Custom JSON dump that knows how to handle all the required formats"""
+    fp.write(json_dumps(obj, **kwargs))
+
+
+def json_dumps(obj, **kwargs):
+    """Custom JSON dumps that knows how to handle all the required formats"""
+    if not kwargs:
+        return _JSON_ENCODER.encode(obj)
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, default=obj_to_json, **kwargs)
+
+
+class StravaBackup:
+    """Download your data from Strava"""
+
+    def __init__(self, *, access_token, email, password, jwt, out_dir, rescan=False,
+                 rate_limiter=None, compress=None, dedup=False, layout="tree", tracks=False,
+                 metrics=None):
+        self.out_dir = out_dir
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics or Metrics()
+
+        if tracks:
+            check_tracks()
+        self.tracks = tracks
+
+        check_compression(compress)
+        self.compress = compress
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown layout '{}'".format(layout))
+        if dedup and layout != TreeStorage.layout:
+            raise ValueError("Deduplication is only supported by the tree layout")
+
+        if not access_token:
+            raise ValueError("An access_token is required")
+
+        self._email = email
+        self._password = password
+        self._stopping = threading.Event()
+        self.client = self._make_client(
+            access_token, email, password, self._validate_jwt(jwt),
+            rate_limiter=rate_limiter, metrics=self.metrics
+        )
+        self.metrics.attach(getattr(self.client.protocol, "rsession", None), "api")
+        self.metrics.attach(getattr(self.client, "_session", None), "web")
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        self._index = Index(os.path.join(self.out_dir, INDEX_FILENAME))
+        self._storage = self._make_storage(layout, dedup)
+        with self.metrics.phase("scan"):
+            self._have = self._find_existing_data(rescan=rescan)
+        self._redownloads = set()
+        self._failures = self._index.failures()
+
+        # Photos are served from a CDN, not the API - reuse connections to it
+        # and download them in parallel (blocking when the pool is exhausted
+        # limits the number of connections per host)
+        self._photo_session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=PHOTO_CONNECTIONS_PER_HOST,
+            pool_block=True,
+        )
+        self._photo_session.mount("https://", adapter)
+        self._photo_session.mount("http://", adapter)
+        self.metrics.attach(self._photo_session, "photo")
+        self._photo_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PHOTO_WORKERS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self._photo_pool.shutdown()
+        self._photo_session.close()
+        self._storage.close()
+        self._index.close()
+
+    @property
+    def activity_dir(self):
+        return os.path.join(self.out_dir, ACTIVITY_DIR)
+
+    @property
+    def photo_dir(self):
+        return os.path.join(self.out_dir, PHOTO_DIR)
+
+    @property
+    def gear_dir(self):
+        return os.path.join(self.out_dir, GEAR_DIR)
+
+    @property
+    def blob_dir(self):
+        return os.path.join(self.out_dir, BLOB_DIR)
+
+    @property
+    def jwt(self):
+        return self.client.jwt
+
+    @staticmethod
+    def _jwt_expiry(jwt):
+        """Get the time a JWT expires"""
+        _, payload, _ = jwt.split('.')  # header.payload.signature
+        payload += "=" * (4 - len(payload) % 4)  # ensure correct padding
+        data = json.loads(base64.b64decode(payload, validate=True))
+        __log__.debug("JWT token data: %s", data)
+        return datetime.datetime.fromtimestamp(data["exp"])
+
+    @classmethod
+    def _validate_jwt(cls, jwt):
+        """Validate the JWT
+
+        Warns of the expiry time of a valid JWT.
+        Returns None if the JWT is invalid/expired.
+        """
+        if not jwt:
+            return None
+
+        try:
+            expiry = cls._jwt_expiry(jwt)
+        except Exception:
+            __log__.error("Failed to parse provided JWT '%s' - ignoring it", jwt, exc_info=True)
+            return None
+
+        now = datetime.datetime.now()
+        if expiry < now:
+            __log__.error("Provided JWT token expired on %s - ignoring it", expiry)
+            return None
+
+        __log__.info(
+            "Using a JWT token that will expire on %s (in %s)",
+            expiry,
+            expiry-now
+        )
+        return jwt
+
+    def refresh_web_session(self, margin=datetime.timedelta(minutes=30)):
+        """Log into the website again if the web session expires within `margin`
+
+        Requires the email and password. Returns if it logged in again.
+        """
+        try:
+            expiry = self._jwt_expiry(self.jwt)
+        except Exception:
+            expiry = None
+        if expiry is not None and expiry - datetime.datetime.now() > margin:
+            return False
+        if not (self._email and self._password):
+            __log__.warning("The web session expires at %s and can't be renewed without an "
+                            "email and password", expiry)
+            return False
+
+        __log__.info("Logging into the website again (the session expires at %s)", expiry)
+        self._web_request()
+        self.client._csrf = None
+        self.client._session.cookies.clear()
+        self.client._login_with_password(self._email, self._password)
+        return True
+
+    def stop(self):
+        """Stop a backup that's in progress (from another thread)
+
+        The activities that are being downloaded are still saved.
+        """
+        self._stopping.set()
+
+    @staticmethod
+    def _make_client(access_token, email, password, jwt, rate_limiter=None, metrics=None):
+        kwargs = {}
+        if rate_limiter:
+            # Schedule all API requests with the rate limiter instead of
+            # having stravalib raise errors when the limits are exceeded
+            kwargs["rate_limit_requests"] = False
+            kwargs["requests_session"] = RateLimitedSession(rate_limiter, metrics=metrics)
+
+        # attempt login via JWT
+        if jwt:
+            try:
+                return WebClient(
+                    access_token=access_token,
+                    jwt=jwt,
+                    **kwargs
+                )
+            except AuthError:
+                __log__.error("Failed to login with JWT", exc_info=True)
+
+        if email and password:
+            # Attempt login using the email/password
+            try:
+                return WebClient(
+                    access_token=access_token,
+                    email=email,
+                    password=password,
+                    **kwargs
+                )
+            except AuthError:
+                __log__.error("Failed to login with email + password", exc_info=True)
+
+        raise AuthError("Failed to log into account")
+
+    def _web_request(self):
+        """Wait until a request to the website can be made"""
+        if self.rate_limiter:
+            waited = self.rate_limiter.acquire("web")
+            self.metrics.count("rate_limit_wait_seconds", waited, kind="web")
+
+    def _make_storage(self, layout, dedup):
+        """Make the storage for the output directory
+
+        The layout of an existing output directory can't be changed (it needs
+        to be converted instead).
+        """
+        storage = open_storage(self.out_dir, self._index, layout=layout, dedup=dedup)
+        if storage.layout != layout:
+            storage.close()
+            raise ValueError(
+                "The output directory '{}' uses the '{}' layout, not '{}' "
+                "(see `strava-backup convert`)".format(self.out_dir, storage.layout, layout)
+            )
+        return storage
+
+    def _ensure_output_dirs(self, gear=True, photos=True):
+        if self._storage.layout != TreeStorage.layout:
+            return
+        os.makedirs(self.activity_dir, exist_ok=True)
+        if photos:
+            os.makedirs(self.photo_dir, exist_ok=True)
+        if gear:
+            os.makedirs(self.gear_dir, exist_ok=True)
+
+    def _find_existing_data(self, rescan=False):
+        """Load the existing data from the index
+
+        The index is (re)built from the files in the output dir if it hasn't
+        been populated yet or a rescan is requested.
+        """
+        update_index(self._index, self._storage, rescan=rescan)
+
+        # Files that were found to be bad need to be downloaded again (even
+        # if they were found by a rescan)
+        for path in self._index.redownloads():
+            self._index.remove_file(path)
+
+        # layout is [meta, data, {photoid: [photo_meta, photo_data]}]
+        have = defaultdict(lambda: [False, False, defaultdict(lambda: [False, False])])
+        for _, activity_id, photo_id, meta, _ in self._index.files():
+            if photo_id is None:
+                have[activity_id][0 if meta else 1] = True
+            else:
+                have[activity_id][2][photo_id][0 if meta else 1] = True
+        return have
+
+    def _mark_saved(self, obj, path, size, meta=False):
+        """Record that a file for an activity or photo was saved"""
+        if isinstance(obj, stravalib.model.Activity):
+            activity_id, photo_id = obj.id, None
+            self._have[activity_id][0 if meta else 1] = True
+        elif isinstance(obj, stravalib.model.ActivityPhoto):
+            activity_id, photo_id = obj.activity_id, str(obj.unique_id or obj.id)
+            self._have[activity_id][2][photo_id][0 if meta else 1] = True
+        else:
+            return
+
+        self._index.add_file(path, activity_id, photo_id, meta, size)
+        if not meta:
+            self._clear_failure(activity_id, photo_id)
+
+    def _record_failure(self, activity_id, photo_id, exc):
+        """Record that downloading an activity's original data or a photo failed
+
+        It's retried by later runs with an exponential backoff. Things that
+        no longer exist (or keep failing) are given up on.
+        """
+        if isinstance(exc, FATAL_ERRORS):
+            raise exc
+
+        _, attempts, _ = self._failures.get((activity_id, photo_id), (None, 0, None))
+        attempts += 1
+        reason = str(exc) or type(exc).__name__
+        if photo_id is None:
+            what = "activity {}".format(activity_id)
+        else:
+            what = "photo {} of activity {}".format(photo_id, activity_id)
+
+        if (isinstance(exc, stravalib.exc.ObjectNotFound) or
+                _failure_status(exc) in GONE_STATUS_CODES or attempts >= MAX_ATTEMPTS):
+            next_attempt = None
+            __log__.warning("Failed to download %s (%s) - giving up after %d attempt(s)",
+                            what, reason, attempts)
+        else:
+            delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+            next_attempt = (datetime.datetime.utcnow() + delay).strftime(TIME_FMT)
+            __log__.warning("Failed to download %s (%s) - will retry after %s",
+                            what, reason, next_attempt)
+
+        self._failures[(activity_id, photo_id)] = (reason, attempts, next_attempt)
+        self._index.add_failure(activity_id, photo_id, reason, attempts, next_attempt)
+        self.metrics.count("download_failures", kind="activity" if photo_id is None else "photo")
+
+    def _clear_failure(self, activity_id, photo_id=None):
+        if self._failures.pop((activity_id, photo_id), None) is not None:
+            self._index.remove_failure(activity_id, photo_id)
+
+    def _can_attempt(self, activity_id, photo_id=None):
+        """Check if downloading something that may have failed before can be attempted"""
+        failure = self._failures.get((activity_id, photo_id))
+        if failure is None:
+            return True
+        next_attempt = failure[2]
+        return (next_attempt is not None and
+                datetime.datetime.strptime(next_attempt, TIME_FMT) <= datetime.datetime.utcnow())
+
+    def _gave_up(self, activity_id, photo_id=None):
+        """Check if downloading something failed permanently"""
+        failure = self._failures.get((activity_id, photo_id))
+        return failure is not None and failure[2] is None
+
+    def _finish_download(self, obj, download):
+        """Move a completed download into the storage"""
+        self._storage.add(download.path, self._storage.partial_path(download.path))
+        self._mark_saved(obj, download.path, download.size)
+        self.metrics.count("files_written")
+
+    def _data_path(self, data, ext=META_EXTENSION):
+        """Return the path (relative to the output dir) to save any given object into"""
+        if isinstance(data, stravalib.model.Activity):
+            filename = ACTIVITY_FILENAME.format(
+                start=data.start_date.strftime(TIME_FMT_FILE),
+                id=data.id,
+                ext=ext
+            )
+            path = os.path.join(ACTIVITY_DIR, str(data.start_date.year))
+        elif isinstance(data, stravalib.model.Gear):
+            filename = GEAR_FILENAME.format(
+                id=data.id,
+                ext=ext
+            )
+            path = GEAR_DIR
+        elif isinstance(data, stravalib.model.ActivityPhoto):
+            filename = PHOTO_FILENAME.format(
+                activity_id=data.activity_id,
+                photo_id=data.unique_id or data.id,
+                ext=ext
+            )
+            path = PHOTO_DIR
+            # Split packed photos by year so no single pack grows forever
+            taken = data.created_at or data.uploaded_at
+            if taken and self._storage.layout == PackedStorage.layout:
+                path = os.path.join(PHOTO_DIR, str(taken.year))
+        else:
+            raise AssertionError("Unknown datatype '{}'".format(type(data)))
+
+        return os.path.join(path, filename)
+
+    def _save_metadata(self, obj):
+        """Write the objects's metadata into the correct file"""
+        path = self._data_path(obj)
+        text = json_dumps(obj)
+        data = text.encode("utf8")
+        self._storage.write(path, data)
+        self._mark_saved(obj, path, len(data), meta=True)
+        self.metrics.count("files_written")
+        if isinstance(obj, stravalib.model.Activity):
+            self._index.add_activities([dict(
+                json.loads(text),
+                manual=obj.manual,
+                total_photo_count=obj.total_photo_count,
+            )])
+
+    def have_activity(self, activity, photos=True, metadata=True):
+        """Check if we have an activity (and all it's photos)"""
+        h = self._have[activity.id]
+
+        if metadata and not h[0]:
+            return False
+
+        if not h[1] and not activity.manual and not self._gave_up(activity.id):
+            return False
+
+        if not photos:
+            return True
+
+        # Photos that can't be downloaded don't count as missing
+        complete_photos = [k for k, v in h[2].items() if all(v) or self._gave_up(activity.id, k)]
+        return len(complete_photos) >= activity.total_photo_count
+
+    def _sync_cursor(self, full_sync=False):
+        """Get the time to list activities after for an incremental sync
+
+        Returns None if a full sync is required.
+        """
+        cursor = self._index.get_state("cursor")
+        last_full_sync = self._index.get_state("last_full_sync")
+        if full_sync or not cursor or not last_full_sync:
+            return None
+
+        now = datetime.datetime.utcnow()
+        if now - datetime.datetime.strptime(last_full_sync, TIME_FMT) > FULL_SYNC_INTERVAL:
+            __log__.info("Last full sync was on %s, doing a full sync", last_full_sync)
+            return None
+
+        return datetime.datetime.strptime(cursor, TIME_FMT) - CURSOR_OVERLAP
+
+    def _activities(self, after=None):
+        i = self.client.get_activities(after=after)
+        try:
+            yield from i
+        except stravalib.exc.AccessUnauthorized:
+            __log__.error("Failed to list activities (missing activity:read scope?). Skipping.")
+
+    def _fetch_activity(self, activity_id):
+        """Get a fully-detailed activity by its ID
+
+        The response is cached so it isn't requested again when the activity
+        is downloaded.
+        """
+        data = self.client.protocol.get("/activities/{id}", id=activity_id,
+                                        include_all_efforts=False)
+        a = stravalib.model.Activity.deserialize(data, bind_client=self.client)
+        self._index.set_cached(a.id, "activity", activity_fingerprint(a), data)
+        return a
+
+    def _queued_activities(self):
+        """Get the activities that have files queued to be downloaded again
+
+        These are fetched by ID since they may be older than the activities
+        that are listed by an incremental sync.
+        """
+        for activity_id in sorted(self._redownloads):
+            try:
+                yield self._fetch_activity(activity_id)
+            except stravalib.exc.ObjectNotFound:
+                __log__.warning("Activity %s was queued to be downloaded again but no longer exists",
+                                activity_id)
+                self._index.remove_redownloads(activity_id)
+
+    def _retry_ids(self):
+        """Get the IDs of the activities with failed downloads that can be attempted again"""
+        return sorted({
+            activity_id for (activity_id, photo_id), (_, _, next_attempt) in self._failures.items()
+            if next_attempt is not None and self._can_attempt(activity_id, photo_id)
+        })
+
+    def _retry_activities(self, activity_ids):
+        """Get the activities with failed downloads that can be attempted again
+
+        These are fetched by ID so they're retried before anything new is
+        downloaded, even if they're older than an incremental sync checks.
+        """
+        __log__.info("Retrying failed downloads from %d activities", len(activity_ids))
+        for activity_id in activity_ids:
+            try:
+                yield self._fetch_activity(activity_id)
+            except Exception as e:
+                self._record_failure(activity_id, None, e)
+
+    def backup_activity(self, activity_id, *, metadata=True, photos=True, update=False,
+                        athlete_id=None):
+        """Back up a single activity by its ID
+
+        If `update` is set, the metadata is saved again even if it was already
+        backed up (ex: the activity was renamed). If `athlete_id` is set, the
+        activity is only backed up if it belongs to that athlete. Returns if
+        anything was saved.
+        """
+        try:
+            a = self._fetch_activity(activity_id)
+        except stravalib.exc.ObjectNotFound:
+            __log__.warning("Activity %s doesn't exist (was it deleted?)", activity_id)
+            return False
+
+        if athlete_id is not None and a.athlete is not None and a.athlete.id != athlete_id:
+            __log__.warning("Activity %s doesn't belong to athlete %s - ignoring it",
+                            activity_id, athlete_id)
+            return False
+
+        if update and metadata:
+            self._have[a.id][0] = False
+        if self.have_activity(a, photos=photos, metadata=metadata):
+            __log__.debug("Activity %s is already backed up", a)
+            return False
+
+        try:
+            download = self._download_activity(a, metadata=metadata, photos=photos)
+        except Exception as e:
+            self._record_failure(a.id, None, e)
+            return False
+        self._save_activity(download)
+        return True
+
+    def backup_gear(self, dry_run=False):
+        athlete = self.client.get_athlete()
+        if athlete.bikes is None and athlete.shoes is None:
+            __log__.error("Failed to get gear data (missing profile:read_all scope?). Skipping.")
+            return
+
+        bikes = athlete.bikes or []
+        shoes = athlete.shoes or []
+
+        if dry_run:
+            __log__.info(
+                "Would download current gear data from %d bike(s) and %d shoe(s)",
+                len(bikes), len(shoes)
+            )
+            return
+
+        __log__.info(
+            "Downloading current gear data (%d bike(s) and %d shoe(s))",
+            len(bikes), len(shoes)
+        )
+
+        def get_gear(gear):
+            obj = self.client.get_gear(gear)
+            if isinstance(obj, stravalib.model.Bike):
+                self._web_request()
+                obj.components = self.client.get_bike_components(gear.id)
+            return obj
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=GEAR_WORKERS) as pool:
+            for obj in pool.map(get_gear, bikes + shoes):
+                self._save_gear(obj)
+
+    @staticmethod
+    def _history_entry(data, time):
+        """Format a line of a history file for a version of some metadata"""
+        return (json_dumps({"time": time, "data": json.loads(data)}) + "\n").encode("utf8")
+
+    def _save_gear(self, gear):
+        """Save the metadata of gear if it changed
+
+        Every version is also appended to a history file beside it.
+        """
+        path = self._data_path(gear)
+        data = json_dumps(gear).encode("utf8")
+        try:
+            old = self._storage.read(path)
+        except FileNotFoundError:
+            old = None
+        if data == old:
+            __log__.debug("Gear %s hasn't changed", gear.id)
+            self.metrics.count("gear_unchanged")
+            return
+
+        history_path = self._data_path(gear, ext=HISTORY_EXTENSION)
+        try:
+            history = self._storage.read(history_path)
+        except FileNotFoundError:
+            history = b""
+            if old is not None:
+                # Start with the version saved before history was kept
+                saved = datetime.datetime.utcfromtimestamp(self._storage.mtime(path) / 1e9)
+                history = self._history_entry(old, saved.strftime(TIME_FMT))
+        history += self._history_entry(data, datetime.datetime.utcnow().strftime(TIME_FMT))
+
+        __log__.info("Saving new version of gear %s", gear.id)
+        self._storage.write(history_path, history)
+        self._storage.write(path, data)
+        self.metrics.count("files_written", 2)
+
+    def _download_photo(self, url, path):
+        """Download a photo to the partial path for the provided path
+
+        Resumes a previous partial download if possible.
+        """
+        tmp = self._storage.partial_path(path)
+        while True:
+            try:
+                offset = os.path.getsize(tmp)
+            except OSError:
+                offset = 0
+
+            headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+            with self._photo_session.get(url, stream=True, headers=headers) as resp:
+                if offset and resp.status_code == 416:
+                    # Invalid range - start again from the beginning
+                    os.remove(tmp)
+                    continue
+                resp.raise_for_status()
+
+                if resp.status_code == 206:
+                    __log__.debug("Resuming download of %s from byte %d", url, offset)
+                    mode = "ab"
+                    expected = resp.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+                else:
+                    mode = "wb"
+                    expected = resp.headers.get("Content-Length")
+                if "Content-Encoding" in resp.headers or not (expected or "").isdigit():
+                    expected = None
+
+                with open(tmp, mode) as f:
+                    for chunk in resp.iter_content(chunk_size=16384):
+                        f.write(chunk)
+                        self.metrics.count("downloaded_bytes", len(chunk), kind="photo")
+            break
+
+        size = os.path.getsize(tmp)
+        if expected is not None and size != int(expected):
+            raise IOError(
+                "Incomplete download of {} ({} of {} bytes)".format(url, size, expected)
+            )
+        return Download(path=path, size=size)
+
+    def _download_photos(self, photos, photo_data):
+        """Download the missing photos for an activity
+
+        Returns the downloaded photos and a list of (photo_id, exception)
+        tuples for the photos that failed to download.
+        """
+        downloads = []
+        for p in photos:
+            # unique_id for Strava, id for Instagram
+            photo_id = str(p.unique_id or p.id)
+
+            download = None
+            if not photo_data[photo_id][1] and self._can_attempt(p.activity_id, photo_id):
+                url = photo_url(p)
+                if url:
+                    __log__.info("Downloading photo %s", photo_id)
+                    # TODO: Check for filetype instead of assuming jpg
+                    download = self._photo_pool.submit(
+                        self._download_photo, url, self._data_path(p, ext="jpg")
+                    )
+
+            downloads.append((p, not photo_data[photo_id][0], download))
+
+        files, failures = [], []
+        for p, metadata, download in downloads:
+            if download is not None:
+                try:
+                    download = download.result()
+                except Exception as e:
+                    failures.append((str(p.unique_id or p.id), e))
+                    download = None
+            files.append((p, metadata, download))
+        return files, failures
+
+    def _save_photos(self, photos):
+        for p, metadata, download in photos:
+            if metadata:
+                self._save_metadata(p)
+
+            if download is not None:
+                self._finish_download(p, download)
+
+    def backup_photos(self, activity_id, photo_data):
+        photos = self.client.get_activity_photos(activity_id, only_instagram=False, size=5000)
+        files, failures = self._download_photos(photos, photo_data)
+        self._save_photos(files)
+        for photo_id, e in failures:
+            self._record_failure(activity_id, photo_id, e)
+
+    def _cached_request(self, summary, kind, url, **params):
+        """Make an API request for an activity, caching the response
+
+        The cached response is used until the activity summary changes.
+        """
+        fingerprint = activity_fingerprint(summary)
+        data = self._index.get_cached(summary.id, kind, fingerprint)
+        if data is None:
+            data = self.client.protocol.get(url, id=summary.id, **params)
+            self._index.set_cached(summary.id, kind, fingerprint, data)
+        else:
+            __log__.debug("Using cached %s data for activity %s", kind, summary)
+        return data
+
+    def _get_activity(self, summary):
+        """Get the fully-detailed version of an activity summary"""
+        data = self._cached_request(summary, "activity", "/activities/{id}",
+                                    include_all_efforts=False)
+        return stravalib.model.Activity.deserialize(data, bind_client=self.client)
+
+    def _get_activity_photos(self, summary):
+        """Get all the photos for an activity"""
+        data = self._cached_request(summary, "photos", "/activities/{id}/photos",
+                                    photo_sources="true", size=5000)
+        return [stravalib.model.ActivityPhoto.deserialize(p, bind_client=self.client) for p in data]
+
+    def _download_activity(self, a, *, metadata=True, photos=True):
+        """Download everything that's missing for an activity
+
+        Nothing is written to disk so this can be run in a worker thread.
+        """
+        have_meta, have_data, photo_data = self._have[a.id]
+
+        need_photos = photos and a.total_photo_count
+        need_metadata = metadata and not have_meta
+
+        # Get the fully-detailed activity for photos and metadata
+        summary = a
+        if need_photos or need_metadata:
+            a = self._get_activity(summary)
+
+        photo_files, failures = [], []
+        if need_photos:
+            __log__.info("Downloading %d photo(s) from activity %s", a.total_photo_count, a)
+            photo_files, failures = self._download_photos(self._get_activity_photos(summary),
+                                                          photo_data)
+
+        data = track = None
+        if not a.manual and not have_data and self._can_attempt(a.id):
+            try:
+                data = self._download_data(a)
+            except FATAL_ERRORS:
+                raise
+            except Exception as e:
+                failures.append((None, e))
+
+            if data and self.tracks and track_path(data.path):
+                try:
+                    with open(self._storage.partial_path(data.path), "rb") as f:
+                        track = encode_track(data.path, f.read())
+                except Exception:
+                    __log__.warning("Failed to decode a track from activity %s", a, exc_info=True)
+
+        return ActivityDownload(activity=a, metadata=need_metadata, photos=photo_files, data=data,
+                                track=track, failures=failures)
+
+    def _download_data(self, a):
+        """Download the original data of an activity from the website"""
+        self._web_request()
+        data = self.client.get_activity_data(a.id,
+                                             fmt=DataFormat.ORIGINAL,
+                                             json_fmt=DataFormat.GPX)
+        __log__.info("Downloading activity %s (%s)", a, data.filename)
+        ext = data.filename.rsplit(".", 1)[-1]
+        compress = self.compress if compressed_ext(ext, self.compress) != ext else None
+        path = self._data_path(a, ext=compressed_ext(ext, compress))
+        # Can't resume these downloads - always start from the beginning
+        tmp = self._storage.partial_path(path)
+        with open_compressed(tmp, compress) as f:
+            for chunk in data.content:
+                f.write(chunk)
+                self.metrics.count("downloaded_bytes", len(chunk), kind="activity")
+        return Download(path=path, size=os.path.getsize(tmp))
+
+    def _save_activity(self, download):
+        """Write everything downloaded for an activity to disk"""
+        a = download.activity
+
+        self._save_photos(download.photos)
+
+        if download.metadata:
+            self._save_metadata(a)
+
+        if download.data:
+            if download.track:
+                self._storage.write(track_path(download.data.path), download.track)
+                self.metrics.count("files_written")
+            self._finish_download(a, download.data)
+        elif a.manual or self._have[a.id][1]:
+            self._clear_failure(a.id)
+
+        for photo_id, e in download.failures:
+            self._record_failure(a.id, photo_id, e)
+            if photo_id is not None:
+                # Photo URLs expire - get new ones for the next attempt
+                self._index.clear_cached(a.id)
+
+        # The cached responses aren't needed once everything is backed up
+        if self.have_activity(a):
+            self._index.clear_cached(a.id)
+        if a.id in self._redownloads:
+            self._index.remove_redownloads(a.id)
+        self.metrics.count("activities_saved")
+
+    def backup_activities(self, *, limit=None, metadata=True, photos=True, dry_run=False,
+                          full_sync=False, workers=1, order=None, deadline=None):
+        """Back up all activities that are missing data
+
+        `order` is one of ACTIVITY_ORDERS (default: the order the API lists
+        them in). If a `deadline` (a `time.monotonic()` time) is set, no more
+        activities are started once the ones in progress might not finish
+        before it. Everything saved is recorded in the index as soon as it's
+        written so the next run continues where this one stopped.
+        """
+        if order is not None and order not in ACTIVITY_ORDERS:
+            raise ValueError("Unknown order '{}'".format(order))
+
+        after = self._sync_cursor(full_sync=full_sync)
+        if after:
+            __log__.info("Checking for activities that started after %s", after)
+        else:
+            __log__.info("Checking all activities")
+
+        self._redownloads = {a for a, _ in self._index.redownloads().values()}
+        retry_ids = self._retry_ids()
+        if dry_run:
+            # Fetching these would update the index (and count as attempts)
+            if self._redownloads:
+                __log__.info("Would download files from %d activities queued to be downloaded "
+                             "again", len(self._redownloads))
+            if retry_ids:
+                __log__.info("Would retry failed downloads from %d activities", len(retry_ids))
+            self._redownloads.clear()
+            retry_ids = []
+        elif self._redownloads:
+            __log__.info("Downloading files from %d activities queued to be downloaded again",
+                         len(self._redownloads))
+
+        count = 0
+        saved = 0
+        newest = None
+        complete = True
+        seen = set()
+        start = time.monotonic()
+
+        activities = self._activities(after=after)
+        if order is not None:
+            # Everything has to be listed before it can be sorted
+            key, reverse = ACTIVITY_ORDERS[order]
+            activities = sorted(activities, key=key, reverse=reverse)
+
+        consecutive_failures = 0
+
+        def save(a, future):
+            nonlocal saved, consecutive_failures
+            try:
+                download = future.result()
+            except Exception as e:
+                self._record_failure(a.id, None, e)
+                error = e
+            else:
+                self._save_activity(download)
+                saved += 1
+                error = next((e for photo_id, e in download.failures if photo_id is None), None)
+
+            consecutive_failures = consecutive_failures + 1 if error else 0
+            if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                raise RuntimeError(
+                    "Stopping after {} activities failed to download in a row".format(
+                        consecutive_failures)
+                ) from error
+
+        # Activities are downloaded by the workers and written to disk in the
+        # order they were listed. Limit how many can be in progress at once.
+        downloads = deque()
+        max_pending = 2 * workers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                queued = self._queued_activities() if self._redownloads else ()
+                retries = self._retry_activities(retry_ids) if retry_ids else ()
+                for a in itertools.chain(queued, retries, activities):
+                    if a.id in seen:
+                        continue
+                    seen.add(a.id)
+
+                    if limit is not None and count >= limit:
+                        complete = False
+                        break
+
+                    if self._stopping.is_set():
+                        __log__.info("Stopping the backup")
+                        complete = False
+                        break
+
+                    if newest is None or a.start_date > newest:
+                        newest = a.start_date
+
+                    self.metrics.count("activities_listed")
+                    if self.have_activity(a, photos=photos, metadata=metadata):
+                        self.metrics.count("activities_skipped")
+                        if a.id in self._redownloads and not dry_run:
+                            self._index.remove_redownloads(a.id)
+                        continue
+                    if not self._can_attempt(a.id):
+                        self.metrics.count("activities_deferred")
+                        continue
+
+                    count += 1
+
+                    if dry_run:
+                        have_meta, have_data, _ = self._have[a.id]
+                        if not a.manual and not have_data:
+                            __log__.info("Would download activity %s", a)
+                        elif metadata and not have_meta:
+                            __log__.info("Would download metadata for activity %s", a)
+
+                        if photos and a.total_photo_count:
+                            __log__.info("Would download %d photo(s) from activity %s", a.total_photo_count, a)
+
+                        continue
+
+                    if deadline is not None:
+                        # Leave enough time to finish the activities in
+                        # progress and this one at the current rate
+                        now = time.monotonic()
+                        per_activity = (now - start) / saved if saved else 0
+                        if deadline - now <= per_activity * (len(downloads) + 1):
+                            __log__.info("Stopping to stay within the time budget, the next run "
+                                         "will continue from here")
+                            complete = False
+                            break
+
+                    downloads.append((
+                        a, pool.submit(self._download_activity, a, metadata=metadata, photos=photos)
+                    ))
+                    while downloads and (len(downloads) >= max_pending or downloads[0][1].done()):
+                        save(*downloads.popleft())
+
+                while downloads:
+                    save(*downloads.popleft())
+            finally:
+                for _, f in downloads:
+                    f.cancel()
+
+        # Everything listed was backed up - move the cursor forward.
+        # Partial backups (no metadata/photos) don't count.
+        if not complete or dry_run or not (metadata and photos):
+            return
+        if newest:
+            self._index.set_state("cursor", newest.strftime(TIME_FMT))
+        if after is None:
+            self._index.set_state("last_full_sync", datetime.datetime.utcnow().strftime(TIME_FMT))
+
+    def run_backup(self, *, limit=None, metadata=True, gear=True, photos=True, dry_run=False,
+                   full_sync=False, workers=1, order=None, time_budget=None):
+        """Back up everything that's missing
+
+        If a `time_budget` (in seconds) is set, the backup stops before it's
+        exceeded. See `backup_activities` for the other options.
+        """
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+
+        if not dry_run:
+            self._ensure_output_dirs(gear=gear, photos=photos)
+
+        if gear:
+            with self.metrics.phase("gear"):
+                self.backup_gear(dry_run=dry_run)
+
+        with self.metrics.phase("activities"):
+            self.backup_activities(limit=limit, metadata=metadata, photos=photos, dry_run=dry_run,
+                                   full_sync=full_sync, workers=workers, order=order,
+                                   deadline=deadline)
+
+        if not dry_run:
+            self._index.set_state("last_backup", datetime.datetime.utcnow().strftime(TIME_FMT))
+
+        __log__.info(
+            "Saved %d of %d listed activities (%d already backed up) and downloaded %.1f MiB",
+            self.metrics.get("activities_saved"),
+            self.metrics.get("activities_listed"),
+            self.metrics.get("activities_skipped"),
+            (self.metrics.get("downloaded_bytes", kind="activity") +
+             self.metrics.get("downloaded_bytes", kind="photo")) / 2 ** 20,
+        )
@@ -0,0 +1,316 @@
+import hmac
+import http.server
+import json
+import logging
+import queue
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from stravabackup.metrics import write_json, write_prometheus
+from stravabackup.session import TOKEN_REFRESH_MARGIN
+
+
+__log__ = logging.getLogger(__name__)
+
+# How often to check if access tokens need to be refreshed (in seconds)
+TOKEN_CHECK_INTERVAL = 60
+
+# Events are small - don't read request bodies larger than this
+MAX_EVENT_SIZE = 64 * 1024
+
+# The types of activity events that trigger a backup of the activity
+ACTIVITY_EVENTS = ("create", "update")
+
+# How long to wait for the accounts to stop when shutting down (in seconds).
+# Backups that are still running after this are abandoned.
+STOP_TIMEOUT = 30
+
+# How long to wait before retrying a failed sync (in seconds). The delay doubles
+# after each failure in a row, up to the sync interval.
+SYNC_RETRY_DELAY = 5 * 60
+
+# Queued jobs (other than backing up an activity)
+SYNC = "sync"
+STOP = "stop"
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    """Receives events from a Strava push subscription
+
+    Subscriptions are validated using the verify token. Events are passed to
+    `on_event` as soon as they're received so it must not block (Strava
+    requires a response within 2 seconds).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, verify_token, on_event):
+        super().__init__(address, WebhookHandler)
+        self.verify_token = verify_token
+        self.on_event = on_event
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        # Strava validates the callback URL when a subscription is created
+        params = parse_qs(urlsplit(self.path).query)
+        mode, challenge, token = (
+            params.get(k, [None])[0] for k in ("hub.mode", "hub.challenge", "hub.verify_token")
+        )
+        if mode != "subscribe" or challenge is None:
+            self.send_error(404)
+            return
+        if not hmac.compare_digest((token or "").encode("utf8"), self.server.verify_token.encode("utf8")):
+            __log__.warning("Rejected a subscription with an invalid verify token")
+            self.send_error(403)
+            return
+
+        __log__.info("Validated a push subscription")
+        self._send_json({"hub.challenge": challenge})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_EVENT_SIZE:
+            self.send_error(413)
+            return
+        try:
+            event = json.loads(self.rfile.read(length))
+            if not isinstance(event, dict):
+                raise ValueError("Event isn't an object")
+        except ValueError:
+            self.send_error(400)
+            return
+
+        self._send_json({})
+        self.server.on_event(event)
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        __log__.debug("%s - %s", self.address_string(), fmt % args)
+
+
+class AccountWorker:
+    """Runs the backup jobs for an account in a worker thread
+
+    Jobs are run one at a time so the same logged in backup (and its index)
+    can be used for all of them. A sync (incremental backup) is run when the
+    worker is started, then every `sync_interval` seconds (if set) to catch
+    any events that were missed (sooner if it failed). The web session is
+    logged into again before a job is run if it's about to expire (`on_login`
+    is passed the new JWT). The metrics of the backup are reset before each
+    job so they only cover the last one.
+    """
+
+    def __init__(self, name, backup, refresh, expires_at, *, options=None, sync_interval=None,
+                 on_job=None, on_login=None):
+        self.name = name
+        self.backup = backup
+        self.options = options or {}
+        self.sync_interval = sync_interval
+        self.expires_at = expires_at
+        self._refresh = refresh
+        self._on_job = on_job
+        self._on_login = on_login
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+        self.athlete_id = backup.client.get_athlete().id
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stop once the current job is finished (skipping any queued jobs)
+
+        A backup that's in progress stops once the activities that are being
+        downloaded are saved.
+        """
+        self._stopped.set()
+        self.backup.stop()
+        self._queue.put(STOP)
+
+    def join(self, timeout=None):
+        """Wait for the worker to stop, returning if it did"""
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def submit(self, job):
+        """Queue a job unless the same job is already waiting to be run"""
+        with self._lock:
+            if job in self._pending:
+                return
+            self._pending.add(job)
+        self._queue.put(job)
+
+    def refresh_token(self):
+        """Refresh the access token if it's close to expiring"""
+        if self.expires_at - time.time() > TOKEN_REFRESH_MARGIN:
+            return
+        __log__.info("Refreshing the access token of account '%s'", self.name)
+        self.backup.client.access_token, self.expires_at = self._refresh()
+
+    def _refresh_web_session(self):
+        # Only downloading original files requires the web session so run
+        # the job even if this fails
+        try:
+            if self.backup.refresh_web_session() and self._on_login:
+                self._on_login(self.backup.jwt)
+        except Exception:
+            __log__.exception("Failed to log into the website for account '%s'", self.name)
+
+    def _sync_delay(self, failures):
+        """How long to wait before the next sync after `failures` failed in a row"""
+        if not failures:
+            return self.sync_interval
+        return min(SYNC_RETRY_DELAY * 2 ** (failures - 1), self.sync_interval)
+
+    def _run(self):
+        next_sync = time.monotonic()
+        sync_failures = 0
+        self.submit(SYNC)
+        while True:
+            timeout = None
+            if self.sync_interval:
+                timeout = max(next_sync - time.monotonic(), 0)
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                job = SYNC
+            if job == STOP or self._stopped.is_set():
+                return
+
+            with self._lock:
+                self._pending.discard(job)
+            # The first job includes logging in and scanning the output dir
+            if self.backup.metrics.end is not None:
+                self.backup.metrics.reset()
+            self._refresh_web_session()
+            success = False
+            try:
+                if job == SYNC:
+                    __log__.info("Running an incremental backup of account '%s'", self.name)
+                    self.backup.run_backup(**self.options)
+                else:
+                    activity_id, update = job
+                    self.backup.backup_activity(
+                        activity_id,
+                        metadata=self.options.get("metadata", True),
+                        photos=self.options.get("photos", True),
+                        update=update,
+                        athlete_id=self.athlete_id,
+                    )
+                success = True
+            except Exception:
+                __log__.exception("Failed to back up account '%s'", self.name)
+            finally:
+                if job == SYNC and self.sync_interval:
+                    sync_failures = 0 if success else sync_failures + 1
+                    delay = self._sync_delay(sync_failures)
+                    if not success:
+                        __log__.info("Retrying the backup of account '%s' in %d seconds",
+                                     self.name, delay)
+                    next_sync = time.monotonic() + delay
+            self.backup.metrics.finish(success=success)
+            if self._on_job:
+                self._on_job()
+
+
+class Daemon:
+    """Keeps accounts backed up using the events of Strava push subscriptions
+
+    Each account stays logged in (refreshing its access token before it
+    expires) so only the activities that events are received for need to be
+    requested.
+    """
+
+    def __init__(self, address, verify_token, *, metrics_file=None, prometheus_textfile=None):
+        self.server = WebhookServer(address, verify_token, self.handle_event)
+        self.metrics_file = metrics_file
+        self.prometheus_textfile = prometheus_textfile
+        self.workers = {}
+        self._stop = threading.Event()
+        self._metrics_lock = threading.Lock()
+
+    def add_account(self, name, backup, refresh, expires_at, **kwargs):
+        worker = AccountWorker(name, backup, refresh, expires_at, on_job=self._write_metrics,
+                               **kwargs)
+        self.workers[worker.athlete_id] = worker
+        __log__.info("Handling events for account '%s' (athlete %s)", name, worker.athlete_id)
+
+    def handle_event(self, event):
+        __log__.debug("Received event: %s", event)
+        worker = self.workers.get(event.get("owner_id"))
+        if worker is None:
+            __log__.warning("Ignoring an event for unknown athlete %s", event.get("owner_id"))
+            return
+
+        object_type, aspect_type = event.get("object_type"), event.get("aspect_type")
+        if object_type == "activity" and aspect_type in ACTIVITY_EVENTS:
+            try:
+                activity_id = int(event["object_id"])
+            except (KeyError, TypeError, ValueError):
+                __log__.warning("Ignoring an event without a valid activity ID: %s", event)
+                return
+            __log__.info("Activity %s of account '%s' was %sd", activity_id, worker.name, aspect_type)
+            worker.submit((activity_id, aspect_type == "update"))
+        elif object_type == "athlete" and event.get("updates", {}).get("authorized") == "false":
+            __log__.warning("Account '%s' revoked access to the application", worker.name)
+        else:
+            __log__.debug("Ignoring %s %s event", object_type, aspect_type)
+
+    def _write_metrics(self):
+        metrics = {w.name: w.backup.metrics for w in self.workers.values()}
+        with self._metrics_lock:
+            if self.metrics_file:
+                write_json(self.metrics_file, metrics)
+            if self.prometheus_textfile:
+                write_prometheus(self.prometheus_textfile, metrics)
+
+    def _refresh_tokens(self):
+        while not self._stop.wait(TOKEN_CHECK_INTERVAL):
+            for worker in self.workers.values():
+                try:
+                    worker.refresh_token()
+                except Exception:
+                    __log__.exception("Failed to refresh the access token of account '%s'", worker.name)
+
+    def run(self):
+        """Handle events until interrupted"""
+        refresher = threading.Thread(target=self._refresh_tokens, name="token-refresh", daemon=True)
+        refresher.start()
+        for worker in self.workers.values():
+            worker.start()
+
+        __log__.info("Listening for events on %s:%d", *self.server.server_address[:2])
+        try:
+            self.server.serve_forever()
+        finally:
+            self._stop.set()
+            for worker in self.workers.values():
+                worker.stop()
+            deadline = time.monotonic() + STOP_TIMEOUT
+            for worker in self.workers.values():
+                if not worker.join(max(deadline - time.monotonic(), 0)):
+                    __log__.warning("Account '%s' didn't stop in time - abandoning its backup",
+                                    worker.name)
+            refresher.join()
+
+    def close(self):
+        self.server.server_close()
+        for worker in self.workers.values():
+            # Abandoned backups are still using their index and storage
+            if worker.join(0):
+                worker.backup.__exit__(None, None, None)
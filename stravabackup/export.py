@@ -0,0 +1,106 @@
+import csv
+import datetime
+import io
+import logging
+import posixpath
+from collections import namedtuple
+
+from stravabackup.storage import COMPRESSION_EXTENSIONS, compressed_ext
+
+
+__log__ = logging.getLogger(__name__)
+
+# The file in an export that lists all the activities
+EXPORT_ACTIVITIES = "activities.csv"
+
+# The columns of the activities list that are used. Some column names are
+# repeated - the first column with each name is used.
+EXPORT_ID_COLUMN = "Activity ID"
+EXPORT_DATE_COLUMN = "Activity Date"
+EXPORT_FILE_COLUMN = "Filename"
+
+# The formats of the (UTC) start dates in the activities list
+EXPORT_DATE_FORMATS = ("%b %d, %Y, %I:%M:%S %p", "%Y-%m-%d %H:%M:%S")
+
+# An activity in an export and the name of the ZIP entry with its original file
+ExportActivity = namedtuple("ExportActivity", ("id", "start_date", "entry"))
+
+
+def parse_export_date(value):
+    """Parse a start date from the activities list of an export"""
+    # Newer exports use a narrow no-break space before AM/PM
+    value = " ".join(value.split())
+    for fmt in EXPORT_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Unknown date format '{}'".format(value))
+
+
+def export_activities(zf):
+    """Yield an ExportActivity for each activity in an export with an original file
+
+    `zf` is the `zipfile.ZipFile` of the export. Activities without an
+    original file (ex: manual activities) are skipped.
+    """
+    names = set(zf.namelist())
+    lists = [n for n in names if posixpath.basename(n) == EXPORT_ACTIVITIES]
+    if not lists:
+        raise ValueError("'{}' isn't a Strava export (no {} in it)".format(zf.filename,
+                                                                            EXPORT_ACTIVITIES))
+    # The export may have been extracted and zipped again inside a directory
+    name = min(lists, key=lambda n: n.count("/"))
+    prefix = posixpath.dirname(name)
+
+    with zf.open(name) as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+        header = next(reader, [])
+        try:
+            id_col, date_col, file_col = (
+                header.index(c) for c in (EXPORT_ID_COLUMN, EXPORT_DATE_COLUMN, EXPORT_FILE_COLUMN)
+            )
+        except ValueError:
+            raise ValueError("Missing required columns in {}".format(name)) from None
+
+        for line, row in enumerate(reader, start=2):
+            if len(row) <= max(id_col, date_col, file_col) or not row[file_col]:
+                continue
+            try:
+                activity_id, start_date = int(row[id_col]), parse_export_date(row[date_col])
+            except ValueError as e:
+                __log__.warning("Skipping line %d of %s (%s)", line, name, e)
+                continue
+
+            entry = posixpath.join(prefix, row[file_col])
+            if entry not in names:
+                __log__.warning("The original file of activity %s (%s) isn't in the export",
+                                activity_id, row[file_col])
+                continue
+            yield ExportActivity(activity_id, start_date, entry)
+
+
+def stored_ext(filename, compress=None):
+    """Work out how to store an original file from an export
+
+    Files are kept the way they were compressed in the export unless a
+    different compression method is requested. Returns (ext, src, compress):
+    the extension to save the file with, the compression extension to
+    decompress it from (or None), and the method to compress it with (or
+    None).
+    """
+    exts = posixpath.basename(filename).split(".")[1:]
+    if not exts:
+        raise ValueError("'{}' doesn't have an extension".format(filename))
+
+    src = None
+    if len(exts) > 1 and exts[-1].lower() in COMPRESSION_EXTENSIONS.values():
+        src = exts.pop().lower()
+    ext = exts[-1]
+
+    if compress is None or src == COMPRESSION_EXTENSIONS[compress]:
+        return ext if src is None else "{}.{}".format(ext, src), None, None
+    if compressed_ext(ext, compress) == ext:
+        # Already a compressed format
+        return ext, src, None
+    return compressed_ext(ext, compress), src, compress
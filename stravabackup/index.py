@@ -0,0 +1,346 @@
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+
+
+__log__ = logging.getLogger(__name__)
+
+INDEX_FILENAME = ".strava-backup.sqlite"
+
+# The activity metadata fields that can be queried
+ACTIVITY_FIELDS = (
+    "id", "start_date", "name", "description", "type", "commute", "trainer",
+    "distance", "moving_time", "elapsed_time", "total_elevation_gain",
+    "average_speed", "max_speed", "calories", "device_name", "gear_id",
+    "manual", "total_photo_count",
+)
+
+# Fields that aren't in the saved metadata files so are kept when the metadata
+# is re-indexed from them
+EXTRA_ACTIVITY_FIELDS = ("manual", "total_photo_count")
+
+# Each entry upgrades the schema by one version (tracked using the
+# `user_version` pragma). Only ever append to this list.
+MIGRATIONS = [
+    """
+    CREATE TABLE state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE files (
+        path TEXT PRIMARY KEY,
+        activity_id INTEGER NOT NULL,
+        photo_id TEXT,
+        meta INTEGER NOT NULL
+    );
+    CREATE INDEX files_activity_id ON files (activity_id);
+    """,
+    """
+    CREATE TABLE cache (
+        activity_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (activity_id, kind)
+    );
+    """,
+    """
+    ALTER TABLE files ADD COLUMN size INTEGER;
+    """,
+    """
+    CREATE TABLE activities (
+        id INTEGER PRIMARY KEY,
+        start_date TEXT,
+        name TEXT,
+        description TEXT,
+        type TEXT,
+        commute INTEGER,
+        trainer INTEGER,
+        distance REAL,
+        moving_time REAL,
+        elapsed_time REAL,
+        total_elevation_gain REAL,
+        average_speed REAL,
+        max_speed REAL,
+        calories REAL,
+        device_name TEXT,
+        gear_id TEXT
+    );
+    CREATE INDEX activities_start_date ON activities (start_date);
+    CREATE INDEX activities_type ON activities (type);
+    CREATE INDEX activities_gear_id ON activities (gear_id);
+    """,
+    """
+    ALTER TABLE activities ADD COLUMN manual INTEGER;
+    ALTER TABLE activities ADD COLUMN total_photo_count INTEGER;
+    """,
+    """
+    CREATE TABLE checksums (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        error TEXT
+    );
+    CREATE TABLE redownload (
+        path TEXT PRIMARY KEY,
+        activity_id INTEGER NOT NULL,
+        reason TEXT
+    );
+    """,
+    """
+    CREATE TABLE failures (
+        activity_id INTEGER NOT NULL,
+        photo_id TEXT NOT NULL,
+        reason TEXT,
+        attempts INTEGER NOT NULL,
+        next_attempt TEXT,
+        PRIMARY KEY (activity_id, photo_id)
+    );
+    """,
+]
+
+
+class Index:
+    """A persistent index of the data in an output directory
+
+    Paths are stored relative to the output directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._migrate()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _migrate(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        for version, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            __log__.debug("Migrating index %s to version %d", self.path, version)
+            self._db.executescript(
+                "BEGIN;{}PRAGMA user_version = {:d};COMMIT;".format(script, version)
+            )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run a set of statements in a single transaction"""
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            else:
+                self._db.execute("COMMIT")
+
+    def get_state(self, key, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                (key, value)
+            )
+
+    def files(self):
+        """Return (path, activity_id, photo_id, meta, size) for all known files"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT path, activity_id, photo_id, meta, size FROM files"
+            ).fetchall()
+
+    def add_file(self, path, activity_id, photo_id=None, meta=False, size=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (path, activity_id, photo_id, meta, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (path, activity_id, photo_id, bool(meta), size)
+            )
+
+    def remove_file(self, path):
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def replace_files(self, files):
+        """Replace all known files with the provided (path, activity_id, photo_id, meta, size) rows"""
+        with self.transaction() as db:
+            db.execute("DELETE FROM files")
+            db.executemany(
+                "INSERT OR REPLACE INTO files (path, activity_id, photo_id, meta, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((p, a, i, bool(m), sz) for p, a, i, m, sz in files)
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES ('scanned', '1')"
+            )
+
+    def get_cached(self, activity_id, kind, fingerprint):
+        """Get a cached API response for an activity
+
+        Returns None if there is no cached response or it was cached with a
+        different fingerprint.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fingerprint, data FROM cache WHERE activity_id = ? AND kind = ?",
+                (activity_id, kind)
+            ).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        return json.loads(row[1])
+
+    def set_cached(self, activity_id, kind, fingerprint, data):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (activity_id, kind, fingerprint, data) "
+                "VALUES (?, ?, ?, ?)",
+                (activity_id, kind, fingerprint, json.dumps(data))
+            )
+
+    def clear_cached(self, activity_id):
+        with self._lock:
+            self._db.execute("DELETE FROM cache WHERE activity_id = ?", (activity_id,))
+
+    def checksums(self):
+        """Return {path: (size, mtime, sha256, error)} for all scrubbed files"""
+        with self._lock:
+            return {
+                path: tuple(rest) for path, *rest in self._db.execute(
+                    "SELECT path, size, mtime, sha256, error FROM checksums"
+                )
+            }
+
+    def replace_checksums(self, checksums):
+        """Replace the checksums of all files with the provided (path, size, mtime, sha256, error) rows"""
+        with self.transaction() as db:
+            db.execute("DELETE FROM checksums")
+            db.executemany(
+                "INSERT OR REPLACE INTO checksums (path, size, mtime, sha256, error) "
+                "VALUES (?, ?, ?, ?, ?)",
+                checksums
+            )
+
+    def queue_redownload(self, path, activity_id, reason=None):
+        """Queue a (bad) file of an activity to be downloaded again by the next backup"""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO redownload (path, activity_id, reason) VALUES (?, ?, ?)",
+                (path, activity_id, reason)
+            )
+
+    def redownloads(self):
+        """Return {path: (activity_id, reason)} for all files queued to be downloaded again"""
+        with self._lock:
+            return {
+                path: tuple(rest) for path, *rest in self._db.execute(
+                    "SELECT path, activity_id, reason FROM redownload"
+                )
+            }
+
+    def remove_redownloads(self, activity_id):
+        with self._lock:
+            self._db.execute("DELETE FROM redownload WHERE activity_id = ?", (activity_id,))
+
+    def failures(self):
+        """Return {(activity_id, photo_id): (reason, attempts, next_attempt)} for all failures
+
+        `photo_id` is None for failures of the activity itself. `next_attempt`
+        is None if the failure is permanent.
+        """
+        with self._lock:
+            return {
+                (activity_id, photo_id or None): (reason, attempts, next_attempt)
+                for activity_id, photo_id, reason, attempts, next_attempt in self._db.execute(
+                    "SELECT activity_id, photo_id, reason, attempts, next_attempt FROM failures"
+                )
+            }
+
+    def add_failure(self, activity_id, photo_id, reason, attempts, next_attempt):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO failures (activity_id, photo_id, reason, attempts, next_attempt) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (activity_id, photo_id or "", reason, attempts, next_attempt)
+            )
+
+    def remove_failure(self, activity_id, photo_id=None):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM failures WHERE activity_id = ? AND photo_id = ?",
+                (activity_id, photo_id or "")
+            )
+
+    def add_activities(self, activities):
+        """Add (or update) the metadata for activities
+
+        Extra fields that are missing from the metadata keep their current values.
+        """
+        with self.transaction() as db:
+            db.executemany(
+                "INSERT INTO activities ({}) VALUES ({}) ON CONFLICT (id) DO UPDATE SET {}".format(
+                    ", ".join(ACTIVITY_FIELDS),
+                    ", ".join("?" * len(ACTIVITY_FIELDS)),
+                    ", ".join(
+                        "{0} = COALESCE(excluded.{0}, {0})".format(f) if f in EXTRA_ACTIVITY_FIELDS
+                        else "{0} = excluded.{0}".format(f)
+                        for f in ACTIVITY_FIELDS[1:]
+                    )
+                ),
+                ([a.get(f) for f in ACTIVITY_FIELDS] for a in activities)
+            )
+
+    def query_activities(self, *, type=None, gear_id=None, after=None, before=None, fields=None):
+        """Yield the metadata of activities matching the filters as dicts
+
+        `after` and `before` are compared to the start dates as strings so can
+        be any prefix of a time (ex: "2020", "2020-03-01").
+        """
+        fields = fields or ACTIVITY_FIELDS
+        unknown = set(fields) - set(ACTIVITY_FIELDS)
+        if unknown:
+            raise ValueError("Unknown field(s): {}".format(", ".join(sorted(unknown))))
+
+        filters, params = [], []
+        for sql, value in (("type = ?", type), ("gear_id = ?", gear_id),
+                           ("start_date >= ?", after), ("start_date < ?", before)):
+            if value is not None:
+                filters.append(sql)
+                params.append(value)
+
+        query = "SELECT {} FROM activities {} ORDER BY start_date".format(
+            ", ".join(fields),
+            "WHERE " + " AND ".join(filters) if filters else ""
+        )
+        # Don't hold the lock while yielding - the caller might never finish
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        for row in rows:
+            yield dict(zip(fields, row))
+
+    def activity_range(self):
+        """Return the (id, start_date, name) of the oldest and newest activities
+
+        Returns None for both if there aren't any activities.
+        """
+        with self._lock:
+            return tuple(
+                self._db.execute(
+                    "SELECT id, start_date, name FROM activities ORDER BY start_date {} LIMIT 1".format(order)
+                ).fetchone()
+                for order in ("ASC", "DESC")
+            )
+
+    @property
+    def scanned(self):
+        """If the index has been populated from the filesystem"""
+        return self.get_state("scanned") is not None
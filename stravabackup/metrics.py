@@ -0,0 +1,224 @@
+from collections import defaultdict
+import contextlib
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+__log__ = logging.getLogger(__name__)
+
+# The prefix of the names of all metrics exported to Prometheus
+PROMETHEUS_PREFIX = "strava_backup_"
+
+# The upper bounds (in seconds) of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Path segments that are IDs are replaced so requests are grouped by endpoint
+ID_REGEX = re.compile(r"/\d+(?=/|$)")
+
+
+def _key(name, labels):
+    """Format a metric name and its labels like a Prometheus sample"""
+    if not labels:
+        return name
+    return "{}{{{}}}".format(
+        name, ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+    )
+
+
+class Histogram:
+    """Counts observed values in cumulative buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(b): c for b, c in zip(self.buckets, self.counts)},
+        }
+
+
+class Metrics:
+    """Records what happened during a backup and how long it took
+
+    Collects counters, the duration of each phase of the backup, and the
+    latency of requests (by endpoint) of any sessions it's attached to.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.success = None
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._phases = defaultdict(float)
+        self._requests = {}
+
+    def count(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def observe_request(self, endpoint, seconds):
+        with self._lock:
+            histogram = self._requests.get(endpoint)
+            if histogram is None:
+                histogram = self._requests[endpoint] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Record the time spent in a phase of the backup"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] += time.perf_counter() - start
+
+    def attach(self, session, kind):
+        """Record the latency of all requests made by a requests session
+
+        Requests are grouped by endpoint (their path with IDs replaced).
+        """
+        if session is None:
+            return
+
+        def hook(resp, *_, **__):
+            if kind == "photo":
+                # Photos are served from a CDN - the paths are all unique
+                endpoint = kind
+            else:
+                endpoint = "{}:{}".format(kind, ID_REGEX.sub("/{id}", urlsplit(resp.url).path))
+            self.observe_request(endpoint, resp.elapsed.total_seconds())
+
+        session.hooks["response"].append(hook)
+
+    def finish(self, success=True):
+        self.end = time.time()
+        self.success = success
+
+    def reset(self):
+        """Start recording another backup
+
+        Attached sessions stay attached.
+        """
+        with self._lock:
+            self.start = time.time()
+            self.end = None
+            self.success = None
+            self._counters.clear()
+            self._phases.clear()
+            self._requests.clear()
+
+    def summary(self):
+        """Get a summary of the metrics that can be serialized to JSON"""
+        with self._lock:
+            return {
+                "start": datetime.datetime.utcfromtimestamp(self.start).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "duration": (self.end or time.time()) - self.start,
+                "success": self.success,
+                "phases": dict(self._phases),
+                "counters": {
+                    _key(name, dict(labels)): v for (name, labels), v in sorted(self._counters.items())
+                },
+                "requests": {k: v.to_json() for k, v in sorted(self._requests.items())},
+            }
+
+    def prometheus(self, **labels):
+        """Yield (sample, value) for each metric in the Prometheus text format
+
+        The labels are added to every sample.
+        """
+        p = PROMETHEUS_PREFIX
+        with self._lock:
+            yield _key(p + "last_run_timestamp_seconds", labels), self.start
+            yield _key(p + "last_run_duration_seconds", labels), (self.end or time.time()) - self.start
+            yield _key(p + "last_run_success", labels), int(bool(self.success))
+            for phase, seconds in self._phases.items():
+                yield _key(p + "phase_duration_seconds", dict(labels, phase=phase)), seconds
+            for (name, extra), value in self._counters.items():
+                yield _key(p + name, dict(labels, **dict(extra))), value
+            for endpoint, h in self._requests.items():
+                name = p + "request_duration_seconds"
+                endpoint_labels = dict(labels, endpoint=endpoint)
+                for bound, count in zip(h.buckets, h.counts):
+                    yield _key(name + "_bucket", dict(endpoint_labels, le=str(bound))), count
+                yield _key(name + "_bucket", dict(endpoint_labels, le="+Inf")), h.count
+                yield _key(name + "_sum", endpoint_labels), h.sum
+                yield _key(name + "_count", endpoint_labels), h.count
+
+
+# The types and descriptions of the metrics exported to Prometheus. All
+# others are gauges holding the counts from the last backup.
+PROMETHEUS_TYPES = {
+    "last_run_timestamp_seconds": ("gauge", "When the last backup started"),
+    "last_run_duration_seconds": ("gauge", "How long the last backup took"),
+    "last_run_success": ("gauge", "If the last backup was successful"),
+    "phase_duration_seconds": ("gauge", "How long each phase of the last backup took"),
+    "request_duration_seconds": ("histogram", "The time until responses were received"),
+}
+HISTOGRAM_SUFFIX_REGEX = re.compile(r"_(bucket|sum|count)$")
+
+
+def write_prometheus(path, metrics):
+    """Write metrics for a Prometheus textfile collector
+
+    `metrics` is a dict of {account: Metrics}. The file is replaced atomically
+    so it's never read when partially-written.
+    """
+    samples = defaultdict(list)
+    for account, m in metrics.items():
+        for sample, value in m.prometheus(account=account):
+            name = sample.partition("{")[0][len(PROMETHEUS_PREFIX):]
+            base = HISTOGRAM_SUFFIX_REGEX.sub("", name)
+            if PROMETHEUS_TYPES.get(base, (None,))[0] == "histogram":
+                name = base
+            samples[name].append("{} {}".format(sample, value))
+
+    lines = []
+    for name, values in sorted(samples.items()):
+        type_, help_ = PROMETHEUS_TYPES.get(name, ("gauge", None))
+        if help_:
+            lines.append("# HELP {}{} {}".format(PROMETHEUS_PREFIX, name, help_))
+        lines.append("# TYPE {}{} {}".format(PROMETHEUS_PREFIX, name, type_))
+        lines.extend(values)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = "{}.tmp".format(path)
+    with open(tmp, "wt") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def write_json(path, metrics):
+    """Write the summaries of metrics to a JSON file
+
+    `metrics` is a dict of {account: Metrics}.
+    """
+    data = {account: m.summary() for account, m in metrics.items()}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = "{}.tmp".format(path)
+    with open(tmp, "wt") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+
+__log__ = logging.getLogger(__name__)
+
+# Strava uses fixed 15 minute (aligned to the quarter hour) and daily (reset at
+# midnight UTC) windows for its quotas
+WINDOWS = {"short": 15 * 60, "long": 24 * 60 * 60}
+
+# Defaults until the real limits are read from the API response headers
+DEFAULT_API_LIMITS = {"short": 100, "long": 1000}
+
+# Once less than this fraction of a quota is left, the remaining requests are
+# spread out over the rest of the window instead of being used up immediately
+PACE_FRACTION = 0.1
+
+# How often to write the state to disk (in seconds)
+SAVE_INTERVAL = 10
+
+
+class Quota:
+    """A token bucket that is refilled at the end of a fixed window"""
+
+    def __init__(self, window, limit=None, usage=0, reset=0):
+        self.window = window
+        self.limit = limit
+        self.usage = usage
+        self.reset = reset
+
+    def refresh(self, now):
+        """Refill the bucket if the window has ended"""
+        if now >= self.reset:
+            self.usage = 0
+            self.reset = (now // self.window + 1) * self.window
+
+    @property
+    def remaining(self):
+        if self.limit is None:
+            return None
+        return self.limit - self.usage
+
+    def wait_time(self, now, since_last, reserve=0):
+        """How long to wait before the next request can be made"""
+        remaining = self.remaining
+        if remaining is None:
+            return 0
+        if remaining <= reserve:
+            return self.reset - now
+        if remaining - reserve < self.limit * PACE_FRACTION:
+            return (self.reset - now) / (remaining - reserve) - since_last
+        return 0
+
+    def to_json(self):
+        return {"limit": self.limit, "usage": self.usage, "reset": self.reset}
+
+
+class RateLimiter:
+    """Schedules requests to stay within rate limits
+
+    Keeps a quota for each window of each kind of request ("api" for the
+    Strava API, "web" for scraping the website). The API quotas are updated
+    from the rate limit headers of every API response. The state of all quotas
+    can be persisted so multiple runs don't overrun them either. The length of
+    the windows (in seconds) can be overridden using `windows`.
+    """
+
+    def __init__(self, state_file=None, web_limits=None, reserve=2, windows=None):
+        self.state_file = state_file
+        self.reserve = reserve
+        windows = windows or WINDOWS
+
+        self._lock = threading.RLock()
+        self._last_request = {}
+        self._last_save = 0
+        self._quotas = {
+            "api": {k: Quota(w, DEFAULT_API_LIMITS[k]) for k, w in windows.items()},
+            "web": {k: Quota(w, (web_limits or {}).get(k)) for k, w in windows.items()},
+        }
+        self._load()
+
+    def _load(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, "rt") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            __log__.warning("Failed to load rate limit state from '%s'", self.state_file, exc_info=True)
+            return
+
+        for kind, quotas in self._quotas.items():
+            for name, quota in quotas.items():
+                saved = data.get(kind, {}).get(name)
+                if not saved:
+                    continue
+                # Only the API limits come from the server, others are configured
+                if kind == "api" and saved.get("limit"):
+                    quota.limit = saved["limit"]
+                quota.usage = saved.get("usage", 0)
+                quota.reset = saved.get("reset", 0)
+
+    def save(self):
+        if not self.state_file:
+            return
+        with self._lock:
+            data = {
+                kind: {name: q.to_json() for name, q in quotas.items()}
+                for kind, quotas in self._quotas.items()
+            }
+            self._last_save = time.time()
+
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        tmp = "{}.tmp".format(self.state_file)
+        with open(tmp, "wt") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.state_file)
+
+    def acquire(self, kind="api"):
+        """Block until a request of the provided kind can be made
+
+        Returns how long it waited (in seconds).
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.time()
+                since_last = now - self._last_request.get(kind, 0)
+                wait = 0
+                for quota in self._quotas[kind].values():
+                    quota.refresh(now)
+                    wait = max(wait, quota.wait_time(now, since_last, reserve=self.reserve))
+
+                if wait <= 0:
+                    self._last_request[kind] = now
+                    for quota in self._quotas[kind].values():
+                        quota.usage += 1
+                    return waited
+
+            # Wait without holding the lock so other kinds of requests (and
+            # updates from responses) aren't blocked. The quotas are checked
+            # again afterwards since other threads may have used them.
+            if wait > 60:
+                __log__.warning("Rate limit for %s requests almost reached - waiting %ds", kind, wait)
+            else:
+                __log__.debug("Pacing %s requests - waiting %.2fs", kind, wait)
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, headers, kind="api"):
+        """Update the quotas from the rate limit headers of a response"""
+        # Use the stricter read limits if provided (all requests are reads)
+        prefix = "X-ReadRateLimit" if "X-ReadRateLimit-Usage" in headers else "X-RateLimit"
+        try:
+            usage = [int(x) for x in headers[prefix + "-Usage"].split(",")]
+            limits = [int(x) for x in headers[prefix + "-Limit"].split(",")]
+        except (KeyError, ValueError):
+            return
+
+        with self._lock:
+            now = time.time()
+            for quota, u, l in zip(self._quotas[kind].values(), usage, limits):
+                quota.refresh(now)
+                quota.usage = u
+                quota.limit = l
+
+            if now - self._last_save > SAVE_INTERVAL:
+                self.save()
+
+    def exhausted(self, kind="api"):
+        """Mark the short quota as used up (ex: a 429 response was received)"""
+        with self._lock:
+            quota = self._quotas[kind]["short"]
+            quota.refresh(time.time())
+            if quota.limit is not None:
+                quota.usage = max(quota.usage, quota.limit)
+
+
+class RateLimitedSession(requests.Session):
+    """A requests session that schedules all its requests with a RateLimiter
+
+    The time spent waiting and any rate limited responses are recorded in
+    `metrics` (if provided).
+    """
+
+    def __init__(self, limiter, kind="api", metrics=None):
+        super().__init__()
+        self.limiter = limiter
+        self.kind = kind
+        self.metrics = metrics
+
+    def request(self, *args, **kwargs):
+        while True:
+            waited = self.limiter.acquire(self.kind)
+            if self.metrics:
+                self.metrics.count("rate_limit_wait_seconds", waited, kind=self.kind)
+            resp = super().request(*args, **kwargs)
+            self.limiter.update(resp.headers, self.kind)
+            if resp.status_code != 429:
+                return resp
+
+            __log__.warning("Rate limit exceeded, will retry the request")
+            if self.metrics:
+                self.metrics.count("rate_limited_responses", kind=self.kind)
+            self.limiter.exhausted(self.kind)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import xml.parsers.expat
+
+from stravabackup.storage import COMPRESSION_EXTENSIONS, decompress
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+# FIT files use CRC-16/ARC
+FIT_CRC_TABLE = _crc16_table()
+
+FIT_SIGNATURE = b".FIT"
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+
+
+def fit_crc(data, crc=0):
+    """Calculate the CRC of some data the way FIT files do"""
+    table = FIT_CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def check_fit(data):
+    header_size = data[0]
+    if header_size not in (12, 14) or len(data) < header_size:
+        return "invalid FIT header"
+    if data[8:12] != FIT_SIGNATURE:
+        return "missing FIT signature"
+    if header_size == 14:
+        header_crc = struct.unpack("<H", data[12:14])[0]
+        if header_crc and fit_crc(data[:12]) != header_crc:
+            return "invalid FIT header CRC"
+
+    # The data is followed by a 2 byte CRC of the header + data. The CRC of
+    # data with its CRC appended is always 0.
+    end = header_size + struct.unpack("<I", data[4:8])[0] + 2
+    if len(data) < end:
+        return "truncated FIT file ({} of {} bytes)".format(len(data), end)
+    if fit_crc(data[:end]) != 0:
+        return "invalid FIT CRC"
+    return None
+
+
+def check_xml(data):
+    try:
+        xml.parsers.expat.ParserCreate().Parse(bytes(data), True)
+    except xml.parsers.expat.ExpatError as e:
+        return "invalid XML ({})".format(e)
+    return None
+
+
+def check_jpeg(data):
+    if data[:2] != JPEG_START:
+        return "missing JPEG start marker"
+    # Some encoders pad files after the end marker
+    end = len(data)
+    while end and data[end - 1] == 0:
+        end -= 1
+    if data[max(end - 2, 0):end] != JPEG_END:
+        return "missing JPEG end marker (truncated?)"
+    return None
+
+
+def check_json(data):
+    try:
+        json.loads(bytes(data))
+    except ValueError as e:
+        return "invalid JSON ({})".format(e)
+    return None
+
+
+def check_jsonl(data):
+    for i, line in enumerate(bytes(data).splitlines(), start=1):
+        try:
+            json.loads(line)
+        except ValueError as e:
+            return "invalid JSON on line {} ({})".format(i, e)
+    return None
+
+
+# The format checks for files with each extension
+CHECKS = {
+    "fit": check_fit,
+    "gpx": check_xml,
+    "tcx": check_xml,
+    "jpg": check_jpeg,
+    "jpeg": check_jpeg,
+    "json": check_json,
+    "jsonl": check_jsonl,
+}
+
+
+def check_data(filename, data):
+    """Check that the contents of a file look valid for its type
+
+    Compressed files are decompressed first. Returns a description of the
+    problem or None if the file looks fine.
+    """
+    if not len(data):
+        return "empty file"
+
+    exts = os.path.basename(filename).lower().split(".")[1:]
+    if exts and exts[-1] in COMPRESSION_EXTENSIONS.values():
+        try:
+            data = decompress(bytes(data), exts.pop())
+        except Exception as e:
+            return "failed to decompress ({})".format(e)
+        if not data:
+            return "empty file"
+
+    check = CHECKS.get(exts[-1] if exts else None)
+    return check(data) if check else None
+
+
+def scrub_file(filename, path=None, data=None):
+    """Hash and check a file, either at a path or from its data
+
+    Files at a path are memory-mapped instead of being read. Returns
+    (sha256, problem) where problem is None if the file looks fine.
+    """
+    if data is not None:
+        return hashlib.sha256(data).hexdigest(), check_data(filename, data)
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest(), "empty file"
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest(), check_data(filename, m)
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+__log__ = logging.getLogger(__name__)
+
+# Access tokens are refreshed when they expire within this many seconds
+TOKEN_REFRESH_MARGIN = 30 * 60
+
+
+class SessionCache:
+    """Keeps the access token and web session of an account between runs
+
+    Saved as JSON in the state directory (only readable by the user since it
+    contains credentials). Cached tokens are only used with the credentials
+    they were issued for.
+    """
+
+    def __init__(self, state_file, client_id, refresh_token):
+        self.state_file = state_file
+        self.client_id = client_id
+        self._lock = threading.Lock()
+        self._credentials = self._hash_credentials(refresh_token)
+        self._data = {}
+        self._load()
+
+    def _hash_credentials(self, refresh_token):
+        return hashlib.sha256("{}:{}".format(self.client_id, refresh_token).encode("utf8")).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.state_file, "rt") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            __log__.warning("Failed to load the session from '%s'", self.state_file, exc_info=True)
+            return
+
+        if data.get("credentials") != self._credentials:
+            __log__.debug("Ignoring the session in '%s' (credentials changed)", self.state_file)
+            return
+        self._data = data
+
+    def save(self):
+        with self._lock:
+            data = dict(self._data, credentials=self._credentials)
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        tmp = "{}.tmp".format(self.state_file)
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wt") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.state_file)
+
+    def access_token(self, lifetime=0):
+        """Get the cached access token if it won't expire soon
+
+        The token must stay valid for `lifetime` more seconds (on top of the
+        refresh margin).
+        """
+        with self._lock:
+            if self._data.get("expires_at", 0) - time.time() > lifetime + TOKEN_REFRESH_MARGIN:
+                return self._data["access_token"], self._data["expires_at"]
+        return None
+
+    def set_tokens(self, tokens):
+        """Cache the tokens from refreshing the access token"""
+        with self._lock:
+            self._credentials = self._hash_credentials(tokens["refresh_token"])
+            self._data.update(access_token=tokens["access_token"], expires_at=tokens["expires_at"])
+        self.save()
+
+    def clear_access_token(self):
+        """Forget the cached access token (ex: if it was revoked)"""
+        with self._lock:
+            self._data.pop("access_token", None)
+            self._data.pop("expires_at", None)
+        self.save()
+
+    @property
+    def jwt(self):
+        """The token that the web session is restored from"""
+        with self._lock:
+            return self._data.get("jwt")
+
+    @jwt.setter
+    def jwt(self, jwt):
+        with self._lock:
+            self._data["jwt"] = jwt
+        self.save()
@@ -0,0 +1,394 @@
+import contextlib
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+__log__ = logging.getLogger(__name__)
+
+PARTIAL_EXTENSION = "part"
+PACK_EXTENSION = "sqlite"
+
+# Where to put partial files (kept out of the stored files so they can be
+# found without walking all of them)
+PARTIAL_DIR = ".partial"
+
+# How much of a file to copy at once
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Supported compression methods and the extension they add to files
+COMPRESSION_EXTENSIONS = {"gzip": "gz", "zstd": "zst"}
+
+# Files with these extensions are already compressed
+COMPRESSED_EXTENSIONS = {"gz", "zst", "zip", "jpg", "jpeg", "png"}
+
+
+def check_compression(compress):
+    """Raise a ValueError if the compression method can't be used"""
+    if compress is None:
+        return
+    if compress not in COMPRESSION_EXTENSIONS:
+        raise ValueError("Unknown compression method '{}'".format(compress))
+    if compress == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise ValueError("zstd compression requires the 'zstandard' package") from None
+
+
+@contextlib.contextmanager
+def open_compressed(path, compress=None):
+    """Open a file for writing, compressing the data written to it"""
+    with open(path, "wb") as f:
+        if compress is None:
+            yield f
+        elif compress == "gzip":
+            # Don't store the filename or time so identical data compresses identically
+            with gzip.GzipFile(filename="", mode="wb", fileobj=f, mtime=0) as gz:
+                yield gz
+        elif compress == "zstd":
+            import zstandard
+            with zstandard.ZstdCompressor().stream_writer(f) as zst:
+                yield zst
+        else:
+            raise ValueError("Unknown compression method '{}'".format(compress))
+
+
+def decompress(data, ext):
+    """Decompress data that was compressed by the method with the extension
+
+    Data with any other extension is returned as-is.
+    """
+    if ext == COMPRESSION_EXTENSIONS["gzip"]:
+        return gzip.decompress(data)
+    elif ext == COMPRESSION_EXTENSIONS["zstd"]:
+        import zstandard
+        with zstandard.ZstdDecompressor().stream_reader(data) as f:
+            return f.read()
+    return data
+
+
+def open_decompressed(f, ext):
+    """Wrap a file object so the data read from it is decompressed
+
+    Files with an extension that isn't a supported compression method are
+    read as-is.
+    """
+    if ext == COMPRESSION_EXTENSIONS["gzip"]:
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    elif ext == COMPRESSION_EXTENSIONS["zstd"]:
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    return f
+
+
+def compressed_ext(ext, compress=None):
+    """Get the extension for a file after compressing it"""
+    if compress is None or ext.lower() in COMPRESSED_EXTENSIONS:
+        return ext
+    return "{}.{}".format(ext, COMPRESSION_EXTENSIONS[compress])
+
+
+def file_digest(path):
+    """Get the SHA-256 hash of a file"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BlobStore:
+    """Content-addressed storage for files
+
+    Files are stored by the SHA-256 hash of their content and linked to their
+    normal paths so identical files are only stored once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def store(self, src, dest):
+        """Move the file at src into the store and link it to dest
+
+        The src path is used as a temporary path to create the link before
+        moving it into place. Returns the hash of the file.
+        """
+        digest = file_digest(src)
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            __log__.debug("Already have a copy of '%s' (%s)", dest, digest)
+            os.remove(src)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(src, blob)
+
+        try:
+            os.link(blob, src)
+        except OSError:
+            # Fall back to symlinks for filesystems that don't support hardlinks
+            os.symlink(os.path.relpath(blob, os.path.dirname(dest)), src)
+        os.replace(src, dest)
+        return digest
+
+
+class TreeStorage:
+    """Stores files in a directory tree
+
+    All paths are relative to the root directory.
+    """
+
+    layout = "tree"
+
+    def __init__(self, root, blobs=None):
+        self.root = root
+        self.blobs = blobs
+
+    def close(self):
+        pass
+
+    def path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def partial_path(self, relpath):
+        """The (absolute) path to download a file to before it's complete"""
+        path = os.path.join(self.root, PARTIAL_DIR, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.dirname(self.path(relpath)), exist_ok=True)
+        partial = "{}.{}".format(path, PARTIAL_EXTENSION)
+
+        # Older versions kept partial files beside the complete ones
+        with contextlib.suppress(FileNotFoundError):
+            os.replace("{}.{}".format(self.path(relpath), PARTIAL_EXTENSION), partial)
+        return partial
+
+    def add(self, relpath, src):
+        """Move a completed file into the storage"""
+        if self.blobs:
+            self.blobs.store(src, self.path(relpath))
+        else:
+            os.replace(src, self.path(relpath))
+
+    def write(self, relpath, data):
+        tmp = self.partial_path(relpath)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path(relpath))
+
+    def read(self, relpath):
+        with open(self.path(relpath), "rb") as f:
+            return f.read()
+
+    def remove(self, relpath):
+        os.remove(self.path(relpath))
+
+    def mtime(self, relpath):
+        """The modification time of a file in nanoseconds"""
+        return os.stat(self.path(relpath)).st_mtime_ns
+
+    def partial_files(self):
+        """Yield the (absolute) paths of all partially-downloaded files"""
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, PARTIAL_DIR)):
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+
+    def list(self, top):
+        """Yield (relpath, size) for all complete files under the top directory"""
+        for dirpath, _, filenames in os.walk(self.path(top)):
+            for filename in filenames:
+                if filename.endswith("." + PARTIAL_EXTENSION):
+                    continue
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, self.root), os.path.getsize(path)
+
+    def clear(self, relpaths):
+        """Remove the files (and any directories left empty)"""
+        dirs = set()
+        for relpath in relpaths:
+            self.remove(relpath)
+            dirs.add(os.path.dirname(self.path(relpath)))
+
+        for d in sorted(dirs, key=len, reverse=True):
+            with contextlib.suppress(OSError):
+                os.removedirs(d)
+
+        if self.blobs:
+            shutil.rmtree(self.blobs.path, ignore_errors=True)
+
+
+class PackedStorage:
+    """Stores the files in each directory in a single SQLite file
+
+    Ex: 'activities/2020/<name>' is stored as '<name>' in 'activities/2020.sqlite'
+    All paths are relative to the root directory.
+    """
+
+    layout = "packed"
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.RLock()
+        self._packs = {}
+
+    def close(self):
+        with self._lock:
+            for db in self._packs.values():
+                db.close()
+            self._packs.clear()
+
+    def _pack_path(self, dirname):
+        return os.path.join(self.root, "{}.{}".format(dirname, PACK_EXTENSION))
+
+    def _pack(self, dirname, create=True):
+        """Get a connection to the pack for a directory"""
+        with self._lock:
+            db = self._packs.get(dirname)
+            if db is not None:
+                return db
+
+            path = self._pack_path(dirname)
+            if not create and not os.path.exists(path):
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS files "
+                "(name TEXT PRIMARY KEY, data BLOB NOT NULL, mtime INTEGER)"
+            )
+            # Packs from before the modification time of each file was kept
+            # use the time the pack was last modified
+            if "mtime" not in {r[1] for r in db.execute("PRAGMA table_info(files)")}:
+                mtime = os.stat(path).st_mtime_ns
+                db.execute("ALTER TABLE files ADD COLUMN mtime INTEGER")
+                db.execute("UPDATE files SET mtime = ?", (mtime,))
+            self._packs[dirname] = db
+            return db
+
+    def partial_path(self, relpath):
+        """The (absolute) path to download a file to before it's complete"""
+        path = os.path.join(self.root, PARTIAL_DIR, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return "{}.{}".format(path, PARTIAL_EXTENSION)
+
+    def add(self, relpath, src):
+        """Move a completed file into the storage
+
+        The file is copied into the pack in chunks so it's never completely
+        in memory (except on Python < 3.11, which can't write to blobs).
+        """
+        dirname, name = os.path.split(relpath)
+        with open(src, "rb") as f, self._lock:
+            db = self._pack(dirname)
+            if not hasattr(db, "blobopen"):
+                self.write(relpath, f.read())
+            else:
+                db.execute("BEGIN")
+                try:
+                    cur = db.execute(
+                        "INSERT OR REPLACE INTO files (name, data, mtime) VALUES (?, zeroblob(?), ?)",
+                        (name, os.fstat(f.fileno()).st_size, time.time_ns())
+                    )
+                    with db.blobopen("files", "data", cur.lastrowid) as blob:
+                        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+                            blob.write(chunk)
+                    db.execute("COMMIT")
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+        os.remove(src)
+
+    def write(self, relpath, data):
+        dirname, name = os.path.split(relpath)
+        with self._lock:
+            self._pack(dirname).execute(
+                "INSERT OR REPLACE INTO files (name, data, mtime) VALUES (?, ?, ?)",
+                (name, data, time.time_ns())
+            )
+
+    def read(self, relpath):
+        dirname, name = os.path.split(relpath)
+        with self._lock:
+            db = self._pack(dirname, create=False)
+            row = db and db.execute("SELECT data FROM files WHERE name = ?", (name,)).fetchone()
+        if not row:
+            raise FileNotFoundError(relpath)
+        return row[0]
+
+    def remove(self, relpath):
+        dirname, name = os.path.split(relpath)
+        with self._lock:
+            db = self._pack(dirname, create=False)
+            if db:
+                db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def mtime(self, relpath):
+        """The modification time of a file in nanoseconds"""
+        dirname, name = os.path.split(relpath)
+        with self._lock:
+            db = self._pack(dirname, create=False)
+            row = db and db.execute("SELECT mtime FROM files WHERE name = ?", (name,)).fetchone()
+        if not row:
+            raise FileNotFoundError(relpath)
+        return row[0]
+
+    def partial_files(self):
+        """Yield the (absolute) paths of all partially-downloaded files"""
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, PARTIAL_DIR)):
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+
+    def _pack_dirs(self, top):
+        """Get the directories under the top directory that have packs"""
+        if os.path.isfile(self._pack_path(top)):
+            yield top
+        suffix = "." + PACK_EXTENSION
+        for dirpath, _, filenames in os.walk(self.path(top)):
+            for filename in filenames:
+                if filename.endswith(suffix):
+                    yield os.path.relpath(os.path.join(dirpath, filename[:-len(suffix)]), self.root)
+
+    def path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def list(self, top):
+        """Yield (relpath, size) for all files under the top directory"""
+        for dirname in list(self._pack_dirs(top)):
+            with self._lock:
+                rows = self._pack(dirname).execute(
+                    "SELECT name, length(data) FROM files"
+                ).fetchall()
+            for name, size in rows:
+                yield os.path.join(dirname, name), size
+
+    def clear(self, relpaths):
+        """Remove the packs that contain the files"""
+        for dirname in {os.path.dirname(p) for p in relpaths}:
+            with self._lock:
+                db = self._packs.pop(dirname, None)
+                if db:
+                    db.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._pack_path(dirname))
+        shutil.rmtree(os.path.join(self.root, PARTIAL_DIR), ignore_errors=True)
+
+
+LAYOUTS = {s.layout: s for s in (TreeStorage, PackedStorage)}
+
+
+def copy_files(src, dest, tops):
+    """Copy all files in the top directories from one storage to another
+
+    Returns the relative paths of the files that were copied.
+    """
+    relpaths = [p for top in tops for p, _ in src.list(top)]
+    for relpath in relpaths:
+        dest.write(relpath, src.read(relpath))
+    return relpaths
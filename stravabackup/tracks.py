@@ -0,0 +1,188 @@
+import datetime
+import io
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+
+from stravabackup.storage import COMPRESSION_EXTENSIONS, decompress
+
+
+__log__ = logging.getLogger(__name__)
+
+TRACK_EXTENSION = "track.npy"
+
+# The arrays decoded from a track. Stored as a single structured array so the
+# file can be memory-mapped (`numpy.load(path, mmap_mode="r")`)
+TRACK_FIELDS = (
+    ("time", "datetime64[ms]"),
+    ("lat", "f8"),
+    ("lon", "f8"),
+    ("elevation", "f4"),
+    ("heart_rate", "f4"),
+    ("power", "f4"),
+    ("cadence", "f4"),
+)
+
+# The elements (lowercase, without namespaces) of GPX/TCX points that hold
+# each field. Covers the Garmin TrackPointExtension and ActivityExtension
+# schemas as well as the common `power` GPX extension.
+XML_FIELDS = {
+    "time": "time",
+    "latitudedegrees": "lat",
+    "longitudedegrees": "lon",
+    "ele": "elevation",
+    "altitudemeters": "elevation",
+    "hr": "heart_rate",
+    "value": "heart_rate",  # <HeartRateBpm><Value>
+    "power": "power",
+    "watts": "power",
+    "cad": "cadence",
+    "cadence": "cadence",
+    "runcadence": "cadence",
+}
+XML_POINTS = {"trkpt", "trackpoint"}
+
+# FIT positions are stored in semicircles
+SEMICIRCLES_TO_DEGREES = 180 / 2 ** 31
+
+TIME_REGEX = re.compile(r"(.*T\d\d:\d\d:\d\d)(\.\d+)?(.*)")
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def check_tracks():
+    """Raise a ValueError if tracks can't be decoded"""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        raise ValueError("Decoding tracks requires the 'numpy' package") from None
+
+
+def track_path(relpath):
+    """Get the path to store the track decoded from an original file at
+
+    Returns None if tracks can't be decoded from the file.
+    """
+    dirname, filename = os.path.split(relpath)
+    stem, _, ext = filename.partition(".")
+    ext = ext.lower()
+    for compressed in COMPRESSION_EXTENSIONS.values():
+        if ext.endswith("." + compressed):
+            ext = ext[:-len(compressed) - 1]
+    if ext not in PARSERS:
+        return None
+    return os.path.join(dirname, "{}.{}".format(stem, TRACK_EXTENSION))
+
+
+def _parse_time(value):
+    """Parse an ISO 8601 time into milliseconds since the epoch
+
+    Times without a timezone are assumed to be UTC.
+    """
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    # Only Python 3.11+ can parse an arbitrary number of fractional digits
+    m = TIME_REGEX.match(value)
+    if not m:
+        raise ValueError("Invalid time '{}'".format(value))
+    dt = datetime.datetime.fromisoformat(m.group(1) + m.group(3))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return round(((dt - EPOCH).total_seconds() + float(m.group(2) or 0)) * 1000)
+
+
+def _parse_xml(data):
+    """Parse the points from a GPX or TCX file"""
+    for _, elem in ET.iterparse(io.BytesIO(data)):
+        if elem.tag.rsplit("}", 1)[-1].lower() not in XML_POINTS:
+            continue
+
+        point = {}
+        if "lat" in elem.attrib and "lon" in elem.attrib:
+            point["lat"] = float(elem.attrib["lat"])
+            point["lon"] = float(elem.attrib["lon"])
+        for child in elem.iter():
+            field = XML_FIELDS.get(child.tag.rsplit("}", 1)[-1].lower())
+            if field is None or not child.text or not child.text.strip():
+                continue
+            point[field] = _parse_time(child.text) if field == "time" else float(child.text)
+        elem.clear()
+        yield point
+
+
+def _parse_fit(data):
+    """Parse the records from a FIT file"""
+    try:
+        import fitparse
+    except ImportError:
+        raise ValueError("Decoding FIT files requires the 'fitparse' package") from None
+
+    for record in fitparse.FitFile(io.BytesIO(data)).get_messages("record"):
+        values = record.get_values()
+        point = {
+            "heart_rate": values.get("heart_rate"),
+            "power": values.get("power"),
+            "cadence": values.get("cadence"),
+        }
+        elevation = values.get("enhanced_altitude")
+        point["elevation"] = values.get("altitude") if elevation is None else elevation
+        if values.get("position_lat") is not None and values.get("position_long") is not None:
+            point["lat"] = values["position_lat"] * SEMICIRCLES_TO_DEGREES
+            point["lon"] = values["position_long"] * SEMICIRCLES_TO_DEGREES
+        timestamp = values.get("timestamp")
+        if timestamp is not None:
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+            point["time"] = round((timestamp - EPOCH).total_seconds() * 1000)
+        yield point
+
+
+PARSERS = {"gpx": _parse_xml, "tcx": _parse_xml, "fit": _parse_fit}
+
+
+def decode_track(filename, data):
+    """Decode the points of an original activity file into a structured array
+
+    Missing values are NaN (NaT for times). Compressed files are decompressed
+    based on their extension.
+    """
+    import numpy as np
+
+    exts = os.path.basename(filename).lower().split(".")[1:]
+    while exts and exts[-1] in COMPRESSION_EXTENSIONS.values():
+        data = decompress(data, exts.pop())
+    if not exts or exts[-1] not in PARSERS:
+        raise ValueError("Can't decode a track from '{}'".format(filename))
+
+    points = list(PARSERS[exts[-1]](data))
+    track = np.empty(len(points), dtype=list(TRACK_FIELDS))
+    for name, dtype in TRACK_FIELDS:
+        if name == "time":
+            nat = np.iinfo(np.int64).min
+            times = np.array([p.get("time", nat) for p in points], dtype=np.int64)
+            track[name] = times.view(dtype)
+        else:
+            track[name] = np.array(
+                [p.get(name) for p in points], dtype=np.float64
+            )
+    return track
+
+
+def encode_track(filename, data):
+    """Decode the track from an original activity file and serialize it
+
+    Returns the contents of a `.npy` file.
+    """
+    import numpy as np
+
+    f = io.BytesIO()
+    np.save(f, decode_track(filename, data), allow_pickle=False)
+    return f.getvalue()
+
+
+def load_track(path):
+    """Load a track from a file, memory-mapping it"""
+    import numpy as np
+
+    return np.load(path, mmap_mode="r", allow_pickle=False)